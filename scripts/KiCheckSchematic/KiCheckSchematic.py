@@ -2,7 +2,15 @@
 
 import os
 import argparse
+import glob
+import multiprocessing
 import sys
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 common = os.path.abspath(os.path.join(sys.path[0], 'common'))
 if not common in sys.path:
@@ -10,12 +18,47 @@ if not common in sys.path:
 from print_color import *
 
 import render_lib
+import cache
 import file_util
+import geometry
+import hierarchy
+import kicad_sym
+import lib_index
+import netlist
+import report
 import sch
+import watch
 from str_utils import *
 
-errors = 0
-warnings = 0
+class Results (object):
+    """Warnings and errors found checking a project, as counts and as
+    report.Findings, the sheets checked, and in batch mode what the check
+    printed"""
+    def __init__ (self, project=None):
+        self.project = project
+        self.warnings = 0
+        self.errors = 0
+        self.findings = []
+        self.sheets = []
+        self.output = ""
+
+    def add (self, severity, message, sheet, kind, x, y):
+        self.findings.append (report.Finding (severity, self.project, sheet, kind, x, y, message))
+
+    def extend (self, findings):
+        """Add findings of an earlier check of the project"""
+        for finding in findings:
+            self.findings.append (finding)
+            if finding.severity == "error":
+                self.errors += 1
+            else:
+                self.warnings += 1
+
+# the project being checked
+results = Results ()
+
+# the library search paths, listed once for all projects checked by this process
+directories = file_util.DirectoryCache ()
 
 def Info (m):
     if args.verbose:
@@ -24,187 +67,229 @@ def Info (m):
 def Status (m):
     printer.regular(m)
 
-def Warning (m):
-    global warnings
+def Warning (m, sheet=None, kind=None, x=None, y=None):
     printer.yellow ("warning: " + m)
-    warnings +=1
+    results.warnings +=1
+    results.add ("warning", m, sheet, kind, x, y)
 
-def Error (m):
-    global errors
+def Error (m, sheet=None, kind=None, x=None, y=None):
     printer.red ("error: " + m)
-    errors +=1
+    results.errors +=1
+    results.add ("error", m, sheet, kind, x, y)
 
 class CheckSchema:
     def __init__ (self):
         pass
 
-    def Load (self, filename):
-        self.filename = filename
-        self.schema = sch.Schematic (filename)
+    def Load (self, filename, vectorize=False):
+        self.Attach (sch.load (filename), vectorize)
 
-    def Check(self, project):
-        printer.blue ("Checking sheet %s" % (self.schema.filename) )
+    def Attach (self, schema, vectorize=False):
+        self.filename = schema.filename
+        self.schema = schema
+        if vectorize:
+            self.geometry = geometry.GeometryStore (self.schema)
+        else:
+            self.geometry = None
 
-        for comp in self.schema.components:
-            print "%s, %s" % ( comp.labels['ref'], comp.labels ['name'])
+    def Save (self):
+        if self.geometry is not None:
+            self.geometry.write_back()
+        if self.schema.save():
+            Status ("%s saved, %d of %d objects rewritten" % (self.filename, self.schema.rewritten, len(self.schema.objects)))
+        else:
+            Status ("%s unchanged" % self.filename)
 
-            name = comp.labels ['name']
-            found = False
-            # find comp in list
-            for lib in  project.loaded_libs:
-                if lib.find_name (name):
-                    Status ("%s found in %s (%s)" % (name, lib.name, lib.filename))
-                    if found:
-                        Warning ("%s found in multiple libs" % name)
-                    found = True
+    def Check(self, project):
+        printer.blue ("Checking sheet %s" % (self.schema.filename) )
+        results.sheets.append (self.schema.filename)
+
+        # each symbol is looked up once for all components using it
+        for name in self.schema.component_names():
+            comps = self.schema.components_by_name (name)
+            for comp in comps:
+                Info ("%s, %s" % ( comp.labels['ref'], name))
+
+            # libraries defining the name, in project order
+            libs = project.libraries_defining (name)
+            for lib in libs:
+                Info ("%s found in %s (%s)" % (name, lib.name, lib.filename))
+
+            if libs:
+                self.check_units (comps, libs[0].find_name (name.rpartition (":")[2]))
+                if len(libs) > 1 and name not in project.multiple_reported:
+                    project.multiple_reported.add (name)
+                    Warning ("%s found in multiple libs (%s)" % (name, ", ".join (lib.filename for lib in libs)),
+                             kind="library")
+            else:
+                Error("%s not found (%s)" % (name, ", ".join (comp.labels['ref'] for comp in comps)),
+                      self.schema.filename, "comp", comps[0].posx, comps[0].posy)
 
-            if not found:
-                Error("%s not found" % (name))
+    def check_units (self, comps, symbol):
+        for comp in comps:
+            unit = comp.unit.get ('unit', '1')
+            if unit.isdigit() and int(unit) > symbol.n_units:
+                Error ("%s uses unit %s of %s, which has %d" % (comp.labels['ref'], unit, symbol.name, symbol.n_units),
+                       self.schema.filename, "comp", comp.posx, comp.posy)
 
-    def check_pos (self, gridsize, desc, x, y):
-        x = int(x)
-        y = int(y)
+    def check_pos (self, gridsize, kind, desc, x, y):
         if x % gridsize == 0 and y % gridsize == 0:
             return
         else:
-            Error ("%s is not on grid (%d, %d)" % (desc, x, y))
+            Error ("%s is not on grid (%d, %d)" % (desc, x, y), self.schema.filename, kind, x, y)
+
+    def describe (self, kind, item):
+        if kind == "comp":
+            return "comp %s" % item.labels['ref']
+        elif kind == "text":
+            return "text %s" % item.data
+        elif kind in ["wire", "entry"]:
+            return "%s %s" % (kind, item.type1)
+        else:
+            return kind
+
+    def check_grid_vectorized (self, gridsize):
+        store = self.geometry
+        for row in store.off_grid (gridsize):
+            kind, item, point = store.row_item (row)
+            x, y = int(store.x[row]), int(store.y[row])
+            Error ("%s is not on grid (%d, %d)" % (self.describe (kind, item), x, y), self.schema.filename, kind, x, y)
 
     def CheckGrid (self, gridsize):
+        results.sheets.append (self.schema.filename)
+        if self.geometry is not None:
+            self.check_grid_vectorized (gridsize)
+            return
+
+        # the listing of all items is only formatted when shown
+        verbose = args.verbose
+
         # todo component items?
         for item in self.schema.components:
-            print "comp %s: %s,%s" % ( item.labels['ref'], item.posx, item.posy )
+            if verbose:
+                Info ("comp %s: %s,%s" % ( item.labels['ref'], item.posx, item.posy ))
 
-            self.check_pos (gridsize, "comp %s" % item.labels['ref'], item.posx, item.posy)
+            self.check_pos (gridsize, "comp", "comp %s" % item.labels['ref'], item.posx, item.posy)
 
         for item in self.schema.texts:
-            print "text %s: %s,%s" % ( item.data, item.posx, item.posy )
+            if verbose:
+                Info ("text %s: %s,%s" % ( item.data, item.posx, item.posy ))
 
-            self.check_pos (gridsize, "text %s" % item.data, item.posx, item.posy)
+            self.check_pos (gridsize, "text", "text %s" % item.data, item.posx, item.posy)
 
         for item in self.schema.wires:
-            print "wire %s: %s,%s %s,%s" % ( item.type1, item.startx, item.starty, item.endx, item.endy  )
+            if verbose:
+                Info ("wire %s: %s,%s %s,%s" % ( item.type1, item.startx, item.starty, item.endx, item.endy  ))
 
-            self.check_pos (gridsize, "wire %s" % item.type1, item.startx, item.starty)
-            self.check_pos (gridsize, "wire %s" % item.type1, item.endx, item.endy)
+            self.check_pos (gridsize, "wire", "wire %s" % item.type1, item.startx, item.starty)
+            self.check_pos (gridsize, "wire", "wire %s" % item.type1, item.endx, item.endy)
 
         for item in self.schema.entries:
-            print "entry: %s,%s %s,%s" % ( item.startx, item.starty, item.endx, item.endy )
+            if verbose:
+                Info ("entry: %s,%s %s,%s" % ( item.startx, item.starty, item.endx, item.endy ))
 
-            self.check_pos (gridsize, "entry %s" % item.type1, item.startx, item.starty)
-            self.check_pos (gridsize, "entry %s" % item.type1, item.endx, item.endy)
+            self.check_pos (gridsize, "entry", "entry %s" % item.type1, item.startx, item.starty)
+            self.check_pos (gridsize, "entry", "entry %s" % item.type1, item.endx, item.endy)
 
         for item in self.schema.conns:
-            print "conn: %s,%s" % ( item.posx, item.posy )
+            if verbose:
+                Info ("conn: %s,%s" % ( item.posx, item.posy ))
 
-            self.check_pos (gridsize, "junction", item.posx, item.posy)
+            self.check_pos (gridsize, "junction", "junction", item.posx, item.posy)
 
         for item in self.schema.noconns:
-            print "noconn: %s,%s" % ( item.posx, item.posy )
+            if verbose:
+                Info ("noconn: %s,%s" % ( item.posx, item.posy ))
 
-            self.check_pos (gridsize, "noconn", item.posx, item.posy)
+            self.check_pos (gridsize, "noconn", "noconn", item.posx, item.posy)
 
         for item in self.schema.bitmaps:
-            print "bitmap: %s,%s" % ( item.posx, item.posy )
+            if verbose:
+                Info ("bitmap: %s,%s" % ( item.posx, item.posy ))
 
-            self.check_pos (gridsize, "bitmap", item.posx, item.posy)
+            self.check_pos (gridsize, "bitmap", "bitmap", item.posx, item.posy)
 
         for item in self.schema.sheets:
-            print "sheet: %s,%s %s,%s" % ( item.posx, item.posy, item.width, item.height )
-            self.check_pos (gridsize, "sheet", item.posx, item.posy)
+            if verbose:
+                Info ("sheet: %s,%s %s,%s" % ( item.posx, item.posy, item.width, item.height ))
+            self.check_pos (gridsize, "sheet", "sheet", item.posx, item.posy)
 
             for f in item.fields:
                 if not f['id'] in ["F0", "F1"]:
-                    print " field: %s %s,%s" % ( f['id'], f['posx'],  f['posy'])
+                    if verbose:
+                        Info (" field: %s %s,%s" % ( f['id'], f['posx'],  f['posy']))
+
+    # item list of the Schematic -> coordinate attributes, x and y alternating
+    COORDINATES = (
+        ("components",  ("posx", "posy")),
+        ("texts",       ("posx", "posy")),
+        ("wires",       ("startx", "starty", "endx", "endy")),
+        ("entries",     ("startx", "starty", "endx", "endy")),
+        ("conns",       ("posx", "posy")),
+        ("noconns",     ("posx", "posy")),
+        ("bitmaps",     ("posx", "posy")),
+        ("sheets",      ("posx", "posy")),
+        )
+
+    def move_items (self, items, names, func):
+        """Set the coordinates names of each item to func (value, axis),
+        axis 0 for x and 1 for y, marking the items moved as modified"""
+        for item in items:
+            old = [getattr (item, name) for name in names]
+            new = [func (value, i % 2) for i, value in enumerate (old)]
+            if new != old:
+                item.set_modified()
+                for name, value in zip (names, new):
+                    setattr (item, name, value)
 
     def adjust (self, p, offset):
-        return str(int(p) + offset)
+        return p + offset
+
+    def items_moved (self):
+        # keep the spatial index current, with the geometry store the items
+        # are otherwise only updated by Save
+        if self.geometry is not None:
+            if self.schema.spatial is not None:
+                self.geometry.write_back()
+        else:
+            self.schema.items_moved()
 
     def adjust_pos (self, offset):
-        # shift by specified offset
-        for item in self.schema.components:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
-
-        for item in self.schema.texts:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
-
-        for item in self.schema.wires:
-            item.startx = self.adjust (item.startx, offset[0])
-            item.starty = self.adjust (item.starty, offset[1])
-            item.endx = self.adjust (item.endx, offset[0])
-            item.endy = self.adjust (item.endy, offset[1])
-
-        for item in self.schema.entries:
-            item.startx = self.adjust (item.startx, offset[0])
-            item.starty = self.adjust (item.starty, offset[1])
-            item.endx = self.adjust (item.endx, offset[0])
-            item.endy = self.adjust (item.endy, offset[1])
-
-        for item in self.schema.conns:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
-
-        for item in self.schema.noconns:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
-
-        for item in self.schema.bitmaps:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
+        if self.geometry is not None:
+            self.geometry.offset (offset[0], offset[1])
+            self.items_moved()
+            return
 
+        # shift by specified offset
         # todo hierarchical pins
-        for item in self.schema.sheets:
-            item.posx = self.adjust (item.posx, offset[0])
-            item.posy = self.adjust (item.posy, offset[1])
+        for list_name, names in self.COORDINATES:
+            self.move_items (getattr (self.schema, list_name), names, lambda p, axis: self.adjust (p, offset[axis]))
+
+        self.items_moved()
 
     def align (self, p, gridsize):
-        p=int(p)
-        p=p - p % gridsize
-        return str(p)
+        return p - p % gridsize
 
     def align_to_grid (self, gridsize):
-        # shift by specified offset
-        for item in self.schema.components:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
-
-        for item in self.schema.texts:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
-
-        for item in self.schema.wires:
-            item.startx = self.align (item.startx, gridsize)
-            item.starty = self.align (item.starty, gridsize)
-            item.endx = self.align (item.endx, gridsize)
-            item.endy = self.align (item.endy, gridsize)
-
-        for item in self.schema.entries:
-            item.startx = self.align (item.startx, gridsize)
-            item.starty = self.align (item.starty, gridsize)
-            item.endx = self.align (item.endx, gridsize)
-            item.endy = self.align (item.endy, gridsize)
-
-        for item in self.schema.conns:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
-
-        for item in self.schema.noconns:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
+        if self.geometry is not None:
+            self.geometry.align (gridsize)
+            self.items_moved()
+            return
 
-        for item in self.schema.bitmaps:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
+        for list_name, names in self.COORDINATES:
+            self.move_items (getattr (self.schema, list_name), names, lambda p, axis: self.align (p, gridsize))
 
         for item in self.schema.sheets:
-            item.posx = self.align (item.posx, gridsize)
-            item.posy = self.align (item.posy, gridsize)
-
             for f in item.fields:
                 if not f['id'] in ["F0", "F1"]:
-                    f['posx'] = self.align (f['posx'], gridsize)
-                    f['posy'] = self.align (f['posy'], gridsize)
+                    posx = str(self.align (int(f['posx']), gridsize))
+                    posy = str(self.align (int(f['posy']), gridsize))
+                    if (posx, posy) != (f['posx'], f['posy']):
+                        item.set_modified()
+                        f['posx'] = posx
+                        f['posy'] = posy
+
+        self.items_moved()
                     
 class Project:
     def __init__ (self):
@@ -212,11 +297,18 @@ class Project:
         # add installation defaults
         self.lib_paths.append ("c:\programs\kicad\share\kicad\\template")
         self.lib_paths.append ("c:\programs\kicad\share\kicad\library")
+        # KiCad 6: the sym-lib-table files and (nickname, file name) of their libraries
+        self.lib_tables = []
+        self.table_libs = []
 
     def Load (self, filename):
         in_libs = False
         self.libs = []
 
+        if filename.endswith (".kicad_pro"):
+            self.load_lib_tables (filename)
+            return
+
         # add project defined paths
         for line in open (filename, "r"):
             line = line.strip()
@@ -230,7 +322,8 @@ class Project:
             elif line.startswith ("LibDir"):
                 line = after (line, "=")
                 if line:
-                    self.lib_paths.extend(line.split (";"))
+                    # e.g. ${KICAD_LIBS}/symbols
+                    self.lib_paths.extend([os.path.expandvars (path) for path in line.split (";")])
 
         # add project path (default)
         self.lib_paths.append (os.path.split(filename)[0])
@@ -242,6 +335,28 @@ class Project:
         #print self.lib_paths
         #print self.libs
 
+    def load_lib_tables (self, filename):
+        """Take the libraries of a KiCad 6 project from its sym-lib-table and
+        the global one, a nickname of the project hiding a global one"""
+        # libraries are found through the tables only
+        self.lib_paths = []
+        project_dir = os.path.dirname (os.path.abspath (filename))
+        variables = {"KIPRJMOD": project_dir}
+        hidden = set()
+        for table in [os.path.join (project_dir, "sym-lib-table"), kicad_sym.global_lib_table ()]:
+            self.lib_tables.append (table)
+            if not os.path.exists (table):
+                Info ("%s not found" % table)
+                continue
+            nicknames = set()
+            for nickname, path in kicad_sym.read_lib_table (table, variables):
+                if nickname in nicknames:
+                    Warning ("%s is already defined in %s" % (nickname, table), kind="library")
+                elif nickname not in hidden:
+                    self.table_libs.append ((nickname, path))
+                nicknames.add (nickname)
+            hidden |= nicknames
+
     def Check (self):
         # TODO: check for unique lib names
         # todo: relative paths
@@ -249,56 +364,101 @@ class Project:
         printer.blue ("Checking library search paths")
 
         for path in self.lib_paths:
-            if os.path.exists (path):
+            if directories.exists (path):
                 Info ("found %s" % (path))
             else:
-                Error ("%s not found" % (path))
+                Error ("%s not found" % (path), kind="library path")
 
         printer.blue ("Checking libraries")
+        index = library_index ()
         self.unique_libs = {}
-        self.loaded_libs = []
+        # the files to load, in the order of the project, loaded below at once
+        lib_files = []
+        # the nickname of each file for KiCad 6, None for legacy libraries
+        lib_nicknames = []
+        # every file looked for, for --watch
+        self.searched = list (self.lib_tables)
         for lib in self.libs:
             found = False
 
             libname = os.path.basename (lib)
 
             if libname in self.unique_libs:
-                Warning ("%s is already defined" % (lib))
+                Warning ("%s is already defined" % (lib), kind="library")
             else:
                 self.unique_libs [libname] = 1
 
             if "\\" in lib or "/" in lib:
                 full_path = lib + ".lib"
-                if os.path.exists (full_path):
+                self.searched.append (full_path)
+                if directories.contains (os.path.dirname (full_path), os.path.basename (full_path)):
                     Info ("found %s" % (full_path))
                     found = True
 
                     Info ("loading %s" % full_path)
-                    Lib = render_lib.SymbolLibrary ()
-                    Lib.Load (full_path)
-                    self.loaded_libs.append (Lib)
+                    lib_files.append (full_path)
+                    lib_nicknames.append (None)
 
             else:
                 for path in self.lib_paths:
                     full_path = os.path.join (path, lib+".lib")
-                    if os.path.exists (full_path):
+                    self.searched.append (full_path)
+                    if directories.contains (path, lib+".lib"):
                         Info ("found %s" % (full_path))
                         if found:
-                            Warning ("lib found on multiple paths %s" % (full_path))
+                            Warning ("lib found on multiple paths %s" % (full_path), kind="library")
                         else:
                             found = True
 
                         Info ("loading %s" % full_path)
-                        Lib = render_lib.SymbolLibrary ()
-                        Lib.Load (full_path)
-                        self.loaded_libs.append (Lib)
+                        lib_files.append (full_path)
+                        lib_nicknames.append (None)
 
             if not found:
-                Error ( "%s not found" % (lib))
+                Error ( "%s not found" % (lib), kind="library")
+
+        for nickname, full_path in self.table_libs:
+            self.searched.append (full_path)
+            if directories.contains (os.path.dirname (full_path), os.path.basename (full_path)):
+                Info ("loading %s (%s)" % (full_path, nickname))
+                lib_files.append (full_path)
+                lib_nicknames.append (nickname)
+            else:
+                Error ("%s not found (%s)" % (full_path, nickname), kind="library")
+
+        self.loaded_libs = lib_index.load_libraries (lib_files, index)
+        self.lib_nicknames = lib_nicknames
+        self.index_symbols ()
+
+        if index is not None:
+            Info ("library index: %d of %d libraries unchanged" % (index.hits, index.hits + index.misses))
+            pruned = index.prune ([os.path.abspath (name) for name in lib_files])
+            if pruned:
+                Info ("library index: removed %d libraries no longer found" % pruned)
+            index.close()
 
         #
 
 
+    def index_symbols (self):
+        """Map every symbol and alias name to the loaded libraries defining
+        it, names of KiCad 6 libraries as nickname:name"""
+        self.symbols = {}
+        self.multiple_reported = set()
+        for lib, nickname in zip (self.loaded_libs, self.lib_nicknames):
+            for name in lib.all_names ():
+                if nickname is not None:
+                    name = nickname + ":" + name
+                self.symbols.setdefault (name, []).append (lib)
+
+    def libraries_defining (self, name):
+        return self.symbols.get (name, [])
+
+    def files (self):
+        """The library files looked for, and the .dcm files of those loaded"""
+        return self.searched + [render_lib.change_ext (lib.filename, ".dcm") for lib in self.loaded_libs]
+
+
 def ExitError( msg ):
     print(msg)
     sys.exit(-1)
@@ -306,58 +466,333 @@ def ExitError( msg ):
 #
 # main
 #
-parser = argparse.ArgumentParser(description="Check schematic libraries")
-
-parser.add_argument("--project", help="KiCad project file")
-parser.add_argument('--nocolor', help='does not use colors to show the output', action='store_true')
-parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
-
-parser.add_argument("--check_grid",   help="check for grid alignment", action='store_true')
-parser.add_argument("--fix_grid",     help="fix grid alignment", action='store_true')
-parser.add_argument("--grid",         help="grid size (mils) [100]", default=100)
-
-args = parser.parse_args()
-
-if not args.project:
-    ExitError("error: project name not supplied (need --project)")
-
-printer = PrintColor(use_color = not args.nocolor)
+def parse_cache ():
+    """The cache selected by --cache_dir or $KICHECK_CACHE_DIR, None if not enabled"""
+    directory = args.cache_dir or os.environ.get ("KICHECK_CACHE_DIR")
+    if args.no_cache or not directory:
+        return None
+    return cache.ParseCache (directory)
+
+def library_index ():
+    """The index selected by --lib_index or $KICHECK_LIB_INDEX, by default
+    in the cache directory, None if not enabled"""
+    filename = args.lib_index or os.environ.get ("KICHECK_LIB_INDEX")
+    if not filename:
+        directory = args.cache_dir or os.environ.get ("KICHECK_CACHE_DIR")
+        if directory:
+            filename = os.path.join (directory, "libraries.sqlite")
+    if args.no_cache or not filename:
+        return None
+    return lib_index.LibraryIndex (filename)
+
+def root_sheet (project_file):
+    """The root sheet of a project, .kicad_sch for a KiCad 6 .kicad_pro"""
+    if project_file.endswith (".kicad_pro"):
+        return file_util.change_extension (project_file, ".kicad_sch")
+    return file_util.change_extension (project_file, ".sch")
+
+class ProjectCheck:
+    """
+    Check or fix one project. For --watch the project is kept and checked
+    again after some of its files changed: only the changed sheets and
+    libraries are loaded again, and grid checks are done again for the
+    changed sheets only. Library checks are quick and done again for all
+    sheets, a symbol found in several libraries being reported once for
+    the project.
+    """
+    def __init__ (self, project_file):
+        self.project_file = project_file
+        self.project = None
+        # findings of loading the project and its libraries
+        self.project_findings = []
+        self.sheets = None
+        # absolute sheet file name -> (Schematic, findings of its grid check)
+        self.checked = {}
+
+    def files (self):
+        """The files the check depends on"""
+        files = [self.project_file, root_sheet (self.project_file)]
+        if self.project is not None:
+            files += self.project.files()
+        if self.sheets is not None:
+            files += self.sheets.files()
+        return files
+
+    def project_changed (self, changed):
+        if self.project is None or changed is None:
+            return True
+        files = [self.project_file] + self.project.files()
+        return any (os.path.abspath (filename) in changed for filename in files)
+
+    def run (self, changed=None):
+        """Check the project, again after the files in changed (absolute
+        names) changed, or from scratch if changed is None; return the
+        Results"""
+        global results
+        results = Results (self.project_file)
+
+        if args.check_grid or args.fix_grid:
+            self.sheets = load_sheets (self.project_file, self.sheets, changed)
+
+            # sheets used several times are checked and fixed once
+            checked = {}
+            for schema in self.sheets.unique_schematics():
+                key = os.path.abspath (schema.filename)
+                done = self.checked.get (key)
+                if done is not None and done[0] is schema:
+                    Info ("sheet %s unchanged" % schema.filename)
+                    results.sheets.append (schema.filename)
+                    results.extend (done[1])
+                    checked [key] = done
+                    continue
+
+                first = len(results.findings)
+                checker = CheckSchema()
+                checker.Attach (schema, args.vectorize)
+
+                if args.check_grid:
+                    checker.CheckGrid(args.grid)
+
+                #checker.adjust_pos ([50,0])
+                if args.fix_grid:
+                    checker.align_to_grid(100)
+                    checker.Save()
+                checked [key] = (schema, results.findings[first:])
+            self.checked = checked
 
-if args.check_grid or args.fix_grid:
-    if not args.check_grid and not args.fix_grid:
-        args.check_grid = True
-
-    file = file_util.change_extension (args.project, ".sch")
-    checker = CheckSchema()
-    checker.Load (file)
-
-    if args.check_grid:
-        checker.CheckGrid(args.grid)
+        else:
 
-    #checker.adjust_pos ([50,0])
-    if args.fix_grid:
-        checker.align_to_grid(100)
-        checker.schema.save()
+            # get library list from .pro
+            # for each sch file
+            #file = "C:\Python_progs\component_demo\demo\demo_STM32_new\demo_STM32.pro"
+
+            if self.project_changed (changed):
+                if changed is not None:
+                    # library files may have been added or removed
+                    directories.clear ()
+                first = len(results.findings)
+                project = Project ()
+                project.Load(self.project_file)
+                project.Check()
+                self.project = project
+                self.project_findings = results.findings[first:]
+            else:
+                Info ("libraries unchanged")
+                results.extend (self.project_findings)
+                self.project.multiple_reported = set()
+            project = self.project
 
-else:
+            self.sheets = load_sheets (self.project_file, self.sheets, changed)
+            sheets = self.sheets
 
-    # get library list from .pro
-    # for each sch file
-    #file = "C:\Python_progs\component_demo\demo\demo_STM32_new\demo_STM32.pro"
+            for schema in sheets.unique_schematics():
+                checker = CheckSchema()
+                checker.Attach (schema)
+                checker.Check(project)
 
-    file = args.project
-    project = Project ()
-    project.Load(file)
-    project.Check()
+            if args.netlist:
+                nets = netlist.Netlist (sheets, project.loaded_libs)
+                for filename, comp in nets.unresolved:
+                    Warning ("%s: no pins for %s, not in netlist" % (comp.labels['ref'], comp.labels['name']),
+                             filename, "comp", comp.posx, comp.posy)
+                nets.write (args.netlist)
+                Status ("%d nets written to %s" % (len(nets.nets), args.netlist))
 
-    file = file_util.change_extension (args.project, ".sch")
+            printer.blue ("Warnings : %s" % results.warnings)
+            printer.blue ("Errors   : %s" % results.errors)
 
-    checker = CheckSchema()
-    checker.Load (file)
-    checker.Check(project)
+        return results
 
-    printer.blue ("Warnings : %s" % warnings)
-    printer.blue ("Errors   : %s" % errors)
+def check_project (project_file):
+    """Check or fix one project, return its Results"""
+    return ProjectCheck (project_file).run()
 
+#
+# batch mode
+#
+def find_projects (patterns):
+    """Project files named by patterns: files, glob patterns, or
+    directories searched for .pro and .kicad_pro files"""
+    found = []
+    for pattern in patterns:
+        if os.path.isdir (pattern):
+            for root, dirs, files in os.walk (pattern):
+                dirs.sort()
+                for name in sorted (files):
+                    if name.endswith (".pro") or name.endswith (".kicad_pro"):
+                        found.append (os.path.join (root, name))
+        else:
+            # a missing file is kept, to be reported by the check
+            found.extend (sorted (glob.glob (pattern)) or [pattern])
+
+    unique = []
+    for name in found:
+        if name not in unique:
+            unique.append (name)
+    return unique
+
+def init_worker (worker_args):
+    """Set up a batch worker, which checks its projects in one process"""
+    global args, printer
+    args = worker_args
+    args.jobs = 1
+    printer = PrintColor(use_color = not args.nocolor)
+
+def check_buffered (project_file):
+    """check_project, keeping what it prints in the Results. An exception
+    is an error of the project rather than the end of the batch."""
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            check_project (project_file)
+        except Exception as e:
+            Error ("%s: %s: %s" % (project_file, type(e).__name__, e), kind="project")
+        results.output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = saved
+    return results
+
+def check_batch (project_files):
+    """Check many projects in a pool of workers, each loading a library
+    used by several projects once, and print a summary"""
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs == 1:
+        init_worker (args)
+        all_results = (check_buffered (name) for name in project_files)
+        pool = None
+    else:
+        pool = multiprocessing.Pool (jobs, init_worker, (args,))
+        all_results = pool.imap (check_buffered, project_files)
+
+    done = []
+    try:
+        for project_results in all_results:
+            printer.blue ("Project %s" % project_results.project)
+            sys.stdout.write (project_results.output)
+            done.append (project_results)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    printer.blue ("Summary")
+    for project_results in done:
+        Status ("  %s: %d warnings, %d errors" % (project_results.project, project_results.warnings, project_results.errors))
+    printer.blue ("Projects : %d" % len(done))
+    printer.blue ("Warnings : %d" % sum (r.warnings for r in done))
+    printer.blue ("Errors   : %d" % sum (r.errors for r in done))
+    return done
+
+def load_sheets (project_file, sheets=None, changed=None):
+    """Load the sheets of a project, or with --watch load those in changed
+    again, changed being None if it is not known what changed"""
+    if sheets is None or changed is None:
+        sheets = hierarchy.Hierarchy (root_sheet (project_file), args.jobs, cache=parse_cache())
+    else:
+        sheets.reload (changed)
+        for filename in sheets.parsed:
+            Info ("parsed %s" % filename)
+
+    for parent, name in sheets.missing:
+        Error ("%s: sheet file %s not found" % (parent, name), parent, "sheet")
+    for parent, name in sheets.recursive:
+        Error ("%s: sheet %s includes itself" % (parent, name), parent, "sheet")
+
+    for instance in sheets.instances():
+        Info ("sheet %s %s" % (instance.path, instance.filename))
+    return sheets
 
+#
+# watch mode
+#
+def watch_project (project_file):
+    """Check a project, and again each time one of its files changes,
+    until interrupted. Errors reading the files are reported, and the
+    project checked again once they are fixed."""
+    check = ProjectCheck (project_file)
+    watcher = watch.FileWatcher ()
+    changed = None
+    try:
+        while True:
+            start = time.time()
+            try:
+                check.run (changed)
+            except Exception as e:
+                Error ("%s: %s: %s" % (project_file, type(e).__name__, e), kind="project")
+                # check from scratch the next time
+                check = ProjectCheck (project_file)
+            if args.report:
+                report.write ([results], args.report, args.report_format)
+
+            watcher.watch (check.files())
+            printer.blue ("Checked in %.2f s: %d warnings, %d errors. Watching %d files, Ctrl-C to stop" %
+                          (time.time() - start, results.warnings, results.errors, len(watcher.states)))
+
+            changed = watcher.wait()
+            for filename in changed:
+                Status ("changed: %s" % filename)
+            changed = set (changed)
+    except KeyboardInterrupt:
+        pass
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check schematic libraries")
+
+    parser.add_argument("--project", help="KiCad project file")
+    parser.add_argument("projects", nargs="*",
+                        help="more projects to check in batch mode: files, glob patterns or directories")
+    parser.add_argument('--nocolor', help='does not use colors to show the output', action='store_true')
+    parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
+
+    parser.add_argument("--check_grid",   help="check for grid alignment", action='store_true')
+    parser.add_argument("--fix_grid",     help="fix grid alignment", action='store_true')
+    parser.add_argument("--grid",         help="grid size (mils) [100]", type=int, default=100)
+    parser.add_argument("--vectorize",    help="use NumPy for grid check/fix", action='store_true')
+    parser.add_argument("--netlist",      help="write the nets of the sheet hierarchy to a netlist file")
+    parser.add_argument("--jobs",         help="number of worker processes [one per CPU]", type=int)
+    parser.add_argument("--cache_dir",    help="cache parsed sheets in this directory, which must not be shared with other users "
+                                               "[$KICHECK_CACHE_DIR]")
+    parser.add_argument("--lib_index",    help="index of library contents shared by all projects "
+                                               "[$KICHECK_LIB_INDEX, or libraries.sqlite in the cache directory]")
+    parser.add_argument("--report",       help="write the warnings and errors to a file, as JSON Lines or, "
+                                               "for a .xml file, JUnit XML")
+    parser.add_argument("--report_format", help="format of the --report file", choices=report.FORMATS)
+    parser.add_argument("--watch",        help="check again each time a file of the project changes", action='store_true')
+    parser.add_argument("--no-cache",     help="do not use the sheet cache or the library index", action='store_true')
+
+    args = parser.parse_args()
+
+    project_files = find_projects (([args.project] if args.project else []) + args.projects)
+    if not project_files:
+        ExitError("error: project name not supplied (need --project)")
+    if len(project_files) > 1 and args.netlist:
+        ExitError("error: --netlist needs a single project")
+    if len(project_files) > 1 and args.watch:
+        ExitError("error: --watch needs a single project")
+    if args.watch and args.fix_grid:
+        ExitError("error: --watch cannot be used with --fix_grid")
+    if args.fix_grid and any (f.endswith (".kicad_pro") for f in project_files):
+        ExitError("error: --fix_grid cannot save KiCad 6 .kicad_sch sheets")
+
+    printer = PrintColor(use_color = not args.nocolor)
+
+    if args.check_grid or args.fix_grid:
+        if not args.check_grid and not args.fix_grid:
+            args.check_grid = True
+
+        if args.vectorize and not geometry.available():
+            printer.yellow ("--vectorize needs NumPy, try: pip install numpy")
+            printer.yellow ("[Continuing without]")
+            args.vectorize = False
+
+    if args.watch:
+        watch_project (project_files[0])
+        all_results = []
+    elif len(project_files) == 1:
+        all_results = [check_project (project_files[0])]
+    else:
+        all_results = check_batch (project_files)
+
+    if args.report and not args.watch:
+        report.write (all_results, args.report, args.report_format)
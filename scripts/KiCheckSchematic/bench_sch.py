@@ -0,0 +1,1014 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the schematic and library readers
+
+Usage:
+    python bench_sch.py [tokenizer] [loader] [memory] [geometry] [spatial] [netlist] [save] [iter] [cache] [kicad_sch] [kicad_sym] [library] [lib_index] [watch] [resolve] ...
+                        [--lib file.lib ...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import pickle
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import cache
+import file_util
+import geometry
+import hierarchy
+import kicad_sch
+import lib_index
+import netlist
+import render_lib
+import sch
+import sexpr
+import spatial
+import tokenizer
+
+
+#
+# synthetic data
+#
+
+def make_component_lines(n):
+    """Lines as found in $Comp blocks, n components worth"""
+    lines = []
+    for j in range(n):
+        x = 1000 + (j % 100) * 100
+        y = 1000 + (j // 100) * 100
+        lines += [
+            'L Device:R R%d\n' % j,
+            'U 1 1 5A%06X\n' % j,
+            'P %d %d\n' % (x, y),
+            'AR Path="/5B000000/5A%06X" Ref="R%d"  Part="1" \n' % (j, j),
+            'F 0 "R%d" V %d %d 50  0000 C CNN\n' % (j, x + 80, y),
+            'F 1 "10k" V %d %d 50  0000 C CNN\n' % (x, y),
+            'F 2 "Resistors_SMD:R_0603" V %d %d 50  0001 C CNN\n' % (x - 70, y),
+            'F 3 "" H %d %d 50  0001 C CNN\n' % (x, y),
+            ]
+    return lines
+
+
+def make_schematic(filename, n_lines):
+    """Write a synthetic schematic of roughly n_lines lines"""
+    header = [
+        'EESchema Schematic File Version 2\n',
+        'LIBS:power\n',
+        'LIBS:device\n',
+        'EELAYER 25 0\n',
+        'EELAYER END\n',
+        '$Descr A4 11693 8268\n',
+        'encoding utf-8\n',
+        'Sheet 1 1\n',
+        'Title ""\n',
+        '$EndDescr\n',
+        ]
+
+    # each group is 12 lines of component, 8 of wires, 4 of text, 2 of junctions
+    groups = []
+    for j in range(max(1, n_lines // 26)):
+        x = 1000 + (j % 100) * 100
+        y = 1000 + (j // 100) * 100
+        comp = make_component_lines(1)
+        comp[0] = 'L Device:R R%d\n' % j
+        comp[2] = 'P %d %d\n' % (x, y)
+        groups += ['$Comp\n'] + comp + ['\t1    %d %d\n' % (x, y), '\t1    0    0    -1  \n', '$EndComp\n']
+        for k in range(4):
+            groups += ['Wire Wire Line\n', '\t%d %d %d %d\n' % (x, y + k * 10, x + 100, y + k * 10)]
+        groups += ['Text Label %d %d 0    60   ~ 0\n' % (x, y), 'NET%d\n' % j]
+        groups += ['Text GLabel %d %d 0    60   Input ~ 0\n' % (x, y + 50), 'GNET%d\n' % j]
+        groups += ['Connection ~ %d %d\n' % (x, y), 'NoConn ~ %d %d\n' % (x + 50, y)]
+
+    with open(filename, 'w') as f:
+        f.writelines(header + groups + ['$EndSCHEMATC\n'])
+
+
+KICAD_SCH_ITEMS = """  (symbol (lib_id "Device:R") (at {x} {y} 90) (unit 1)
+    (in_bom yes) (on_board yes)
+    (uuid 00000000-0000-0000-0000-{n:012d})
+    (property "Reference" "R{n}" (id 0) (at {x} {y} 90)
+      (effects (font (size 1.27 1.27)))
+    )
+    (property "Value" "10k" (id 1) (at {x} {y} 90)
+      (effects (font (size 1.27 1.27)))
+    )
+    (pin "1" (uuid 00000000-0000-0000-0001-{n:012d}))
+    (pin "2" (uuid 00000000-0000-0000-0002-{n:012d}))
+  )
+  (wire (pts (xy {x} {y}) (xy {x} 12.7))
+    (stroke (width 0) (type default) (color 0 0 0 0))
+    (uuid 00000000-0000-0000-0003-{n:012d})
+  )
+  (label "N{n}" (at {x} {y} 0)
+    (effects (font (size 1.27 1.27)) (justify left bottom))
+    (uuid 00000000-0000-0000-0004-{n:012d})
+  )
+  (junction (at {x} {y}) (diameter 0) (color 0 0 0 0)
+    (uuid 00000000-0000-0000-0005-{n:012d})
+  )
+"""
+
+
+def make_kicad_sch(filename, n_bytes):
+    """A KiCad 6 sheet of about n_bytes"""
+    with open(filename, "w") as f:
+        f.write('(kicad_sch (version 20211123) (generator eeschema)\n')
+        f.write('  (uuid 00000000-0000-0000-0000-000000000000)\n  (paper "A4")\n  (lib_symbols)\n')
+        n = 0
+        while f.tell() < n_bytes:
+            f.write(KICAD_SCH_ITEMS.format(n=n, x="%.2f" % (2.54 * (n % 400)), y="%.2f" % (2.54 * (n // 400))))
+            n += 1
+        f.write(')\n')
+
+
+KICAD_SYM_SYMBOL = """  (symbol "S{n}" (pin_names (offset 1.016)) (in_bom yes) (on_board yes)
+    (property "Reference" "U" (id 0) (at -5.08 6.35 0)
+      (effects (font (size 1.27 1.27)))
+    )
+    (property "Value" "S{n}" (id 1) (at 0 6.35 0)
+      (effects (font (size 1.27 1.27)))
+    )
+    (property "Footprint" "Package_SO:SOIC-8_3.9x4.9mm_P1.27mm" (id 2) (at 0 -7.62 0)
+      (effects (font (size 1.27 1.27)) hide)
+    )
+    (property "ki_description" "Synthetic symbol (8 pins)" (id 4) (at 0 0 0)
+      (effects (font (size 1.27 1.27)) hide)
+    )
+    (symbol "S{n}_0_1"
+      (rectangle (start -5.08 5.08) (end 5.08 -5.08)
+        (stroke (width 0.254) (type default) (color 0 0 0 0))
+        (fill (type background))
+      )
+    )
+    (symbol "S{n}_1_1"
+{pins}    )
+  )
+  (symbol "S{n}_A" (extends "S{n}")
+    (property "Reference" "U" (id 0) (at -5.08 6.35 0)
+      (effects (font (size 1.27 1.27)))
+    )
+  )
+"""
+
+KICAD_SYM_PIN = """      (pin input line (at {x} {y} {angle}) (length 2.54)
+        (name "PIN{k}" (effects (font (size 1.27 1.27))))
+        (number "{num}" (effects (font (size 1.27 1.27))))
+      )
+"""
+
+
+def make_kicad_sym(filename, n_bytes):
+    """A KiCad 6 symbol library of about n_bytes, at least one symbol,
+    symbols S0.. of 8 pins with an alias S0_A..
+    """
+    pins = ''.join(KICAD_SYM_PIN.format(k=k, num=k + 1, x=-7.62 if k < 4 else 7.62,
+                                        y=3.81 - (k % 4) * 2.54, angle=0 if k < 4 else 180)
+                   for k in range(8))
+    with open(filename, "w") as f:
+        f.write('(kicad_symbol_lib (version 20211014) (generator kicad_symbol_editor)\n')
+        n = 0
+        while n == 0 or f.tell() < n_bytes:
+            f.write(KICAD_SYM_SYMBOL.format(n=n, pins=pins))
+            n += 1
+        f.write(')\n')
+
+
+def make_library(filename, n_symbols):
+    """Write a synthetic .lib with a resistor R, plus symbols S0..Sn-1 of 8 pins"""
+    lines = ['EESchema-LIBRARY Version 2.3\n', '#encoding utf-8\n']
+    lines += [
+        '#\n', '# R\n', '#\n',
+        'DEF R R 0 0 N Y 1 F N\n',
+        'F0 "R" 80 0 50 V V C CNN\n',
+        'F1 "R" 0 0 50 V V C CNN\n',
+        'F2 "" -70 0 50 V I C CNN\n',
+        'F3 "" 0 0 50 H I C CNN\n',
+        '$FPLIST\n', ' R_*\n', '$ENDFPLIST\n',
+        'DRAW\n',
+        'S -40 -100 40 100 0 1 10 N\n',
+        'X ~ 1 0 150 50 D 50 50 1 1 P\n',
+        'X ~ 2 0 -150 50 U 50 50 1 1 P\n',
+        'ENDDRAW\n', 'ENDDEF\n',
+        ]
+    for j in range(n_symbols):
+        lines += [
+            '#\n', '# S%d\n' % j, '#\n',
+            'DEF S%d U 0 40 Y Y 1 F N\n' % j,
+            'F0 "U" -200 250 50 H V C CNN\n',
+            'F1 "S%d" 0 250 50 H V C CNN\n' % j,
+            'F2 "Package_SO:SOIC-8_3.9x4.9mm_P1.27mm" 0 -300 50 H I C CNN\n',
+            'F3 "" 0 0 50 H I C CNN\n',
+            'ALIAS S%d_A S%d_B\n' % (j, j),
+            'DRAW\n',
+            'T 0 0 0 50 0 0 0 "Label text" Normal 0 C C\n',
+            'S -200 200 200 -200 0 1 10 f\n',
+            ]
+        for k in range(8):
+            side = k // 4
+            lines.append('X PIN%d %d %d %d 100 %s 50 50 1 1 I\n' % (
+                k, k + 1, -300 if side == 0 else 300, 150 - (k % 4) * 100, 'R' if side == 0 else 'L'))
+        lines += ['ENDDRAW\n', 'ENDDEF\n']
+    lines += ['#\n', '#End Library\n']
+
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+
+
+#
+# reference implementations, as they were before the optimisations
+#
+
+def legacy_tokens(line):
+    line = line.replace('\n', '')
+
+    pieces = re.findall(r'[^\s"]+|(?<!\\)".*?(?<!\\)"', line)
+
+    line = []
+    for i in range(len(pieces)):
+        if pieces[i] and pieces[i][-1] == '=':
+            pieces[i] = pieces[i] + pieces[i+1]
+            pieces[i+1] = ''
+        if pieces[i]:
+            line.append(pieces[i])
+    return line
+
+
+def legacy_split_line(line):
+    line = legacy_tokens(line)
+    key_list = ['id', 'ref', 'orient', 'posx', 'posy', 'size', 'attributes', 'hjust', 'props', 'name']
+    values = line[1:] + ['' for n in range(len(key_list) - len(line[1:]))]
+    return dict(zip(key_list, values))
+
+
+def new_split_line(line):
+    key_list = ['id', 'ref', 'orient', 'posx', 'posy', 'size', 'attributes', 'hjust', 'props', 'name']
+    return tokenizer.make_dict(key_list, tokenizer.split_line(line)[1:])
+
+
+def legacy_split_lib_line(line):
+    s = shlex.shlex(line)
+    s.whitespace_split = True
+    s.commenters = ''
+    s.quotes = '"'
+    return list(s)
+
+
+# lines on which a splitter could go wrong
+LIB_SPLIT_CASES = [
+    '', 'X', 'F0 "R" 80 0 50 V V C CNN', 'F2 "" -70 0 50 V I C CNN',
+    'F4 "a b" 0 0 50 H I C CNN "Field Name"', 'T 0 0 0 50 0 0 0 "Label text" Normal 0 C C',
+    'F0 "abc"def 0', 'F0 ab"c d" 0', 'F0 "unclosed 0 0', 'F0 "a" "', '"', '""', '"""',
+    'F0 "a\\" b"', "F0 'single' 0", 'A\tB\rC', 'A\x0bB\x0cC', 'A\xa0B',
+    'ALIAS a#b c', ]
+
+
+def legacy_find_name(lib, name):
+    for item in lib.items:
+        if item.name == name or name in item.alias:
+            return item
+    return None
+
+
+def make_dcm(filename, lib):
+    """Write a .dcm with a description for every symbol of lib"""
+    with open(filename, 'w') as f:
+        f.write('EESchema-DOCLIB  Version 2.0\n#\n')
+        for item in lib.items:
+            f.write('$CMP %s\nD Description of %s\nK key words\n$ENDCMP\n#\n' % (item.name, item.name))
+        f.write('#End Doc Library\n')
+
+
+def split_differences(lines):
+    """Lines which split_lib_line splits unlike shlex"""
+    def split(func, line):
+        try:
+            return func(line)
+        except ValueError:
+            return ValueError
+    return [line for line in lines
+            if split(legacy_split_lib_line, line) != split(tokenizer.split_lib_line, line)]
+
+
+class LegacyComponent(sch.Component):
+    """Component parsed with a regular expression for every line"""
+    __slots__ = ()
+
+    def _parse(self, data):
+        self.labels = {}
+        self.unit = {}
+        self.references = []
+        self.fields = []
+
+        for line in data:
+            if line[0] == '\t':
+                self.rotation = line.strip()
+                continue
+
+            line = legacy_tokens(line)
+            if line[0] in self._KEYS:
+                key_list = self._KEYS[line[0]]
+                values = line[1:] + ['' for n in range(len(key_list) - len(line[1:]))]
+
+            if line[0] == 'L':
+                self.labels = dict(zip(key_list, values))
+            elif line[0] == 'U':
+                self.unit = dict(zip(key_list, values))
+            elif line[0] == 'P':
+                self.posx = int(values[0])
+                self.posy = int(values[1])
+            elif line[0] == 'AR':
+                self.references.append(dict(zip(key_list, values)))
+            elif line[0] == 'F':
+                self.fields.append(dict(zip(key_list, values)))
+
+
+class LegacySchematic(sch.Schematic):
+    """Schematic loaded with the readline/startswith loop, components
+    parsed as before"""
+    def __init__(self, filename):
+        f = open(filename)
+        self.filename = filename
+        self.header = f.readline()
+        self.libs = []
+        self.eelayer = None
+        self.description = None
+
+        self.components = []
+        self.sheets = []
+        self.bitmaps = []
+        self.texts = []
+        self.wires = []
+        self.entries = []
+        self.conns = []
+        self.noconns = []
+
+        self.objects = []
+
+        building_block = False
+
+        while True:
+            line = f.readline()
+            if not line: break
+
+            if line.startswith('LIBS:'):
+                self.libs.append(line)
+            elif line.startswith('EELAYER END'):
+                pass
+            elif line.startswith('EELAYER'):
+                self.eelayer = line
+
+            elif not building_block:
+                if line.startswith('$'):
+                    building_block = True
+                    block_data = []
+                    block_data.append(line)
+                elif line.startswith('Text'):
+                    data = sch.Text ([line.rstrip(), f.readline().strip()])
+                    self.texts.append(data)
+                    self.objects.append(data)
+                elif line.startswith('Wire'):
+                    data = sch.Wire ([line.rstrip(), f.readline().strip()])
+                    self.wires.append(data)
+                    self.objects.append(data)
+                elif line.startswith('Entry'):
+                    data = sch.Entry ([line.rstrip(), f.readline().strip()])
+                    self.entries.append(data)
+                    self.objects.append(data)
+                elif line.startswith('Connection'):
+                    data = sch.Connection(line)
+                    self.conns.append(data)
+                    self.objects.append(data)
+                elif line.startswith('NoConn'):
+                    data = sch.NoConnect(line)
+                    self.noconns.append(data)
+                    self.objects.append(data)
+
+            elif building_block:
+                block_data.append(line)
+                if line.startswith('$End'):
+                    building_block = False
+
+                    if line.startswith('$EndDescr'):
+                        self.description = sch.Description(block_data)
+                    if line.startswith('$EndComp'):
+                        data = LegacyComponent(block_data)
+                        self.components.append(data)
+                        self.objects.append(data)
+                    if line.startswith('$EndSheet'):
+                        data = sch.Sheet(block_data)
+                        self.sheets.append(data)
+                        self.objects.append(data)
+                    if line.startswith('$EndBitmap'):
+                        data = sch.Bitmap(block_data)
+                        self.bitmaps.append(data)
+                        self.objects.append(data)
+        f.close()
+
+
+#
+# benchmarks
+#
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def report(name, count, unit, before, after):
+    print("%-12s %10d %s" % (name, count, unit))
+    print("  before   %12.0f %s/s  (%.3f s)" % (count / before, unit, before))
+    print("  after    %12.0f %s/s  (%.3f s)" % (count / after, unit, after))
+    print("  speedup  %12.2fx" % (before / after))
+
+
+def bench_tokenizer(args):
+    lines = make_component_lines(args.count // 8)
+
+    for line in lines:
+        assert legacy_split_line(line) == new_split_line(line), line
+
+    def before():
+        for line in lines:
+            legacy_split_line(line)
+
+    def after():
+        for line in lines:
+            new_split_line(line)
+
+    report("tokenizer", len(lines), "lines", best_of(before, args.repeat), best_of(after, args.repeat))
+
+
+def same_objects(a, b):
+    return [i.get_text() for i in a.objects] == [i.get_text() for i in b.objects]
+
+
+def bench_loader(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        with open(filename) as f:
+            n_lines = sum(1 for line in f)
+
+        assert same_objects(LegacySchematic(filename), sch.Schematic(filename))
+
+        before = best_of(lambda: LegacySchematic(filename), args.repeat)
+        after = best_of(lambda: sch.Schematic(filename), args.repeat)
+        report("loader", n_lines, "lines", before, after)
+
+        after = best_of(lambda: sch.Schematic(filename, lazy=True), args.repeat)
+        report("lazy loader", n_lines, "lines", before, after)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def deep_sizeof(obj, seen):
+    """Size of obj and everything it references, objects in seen are not counted again"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            size += deep_sizeof(value, seen)
+    elif hasattr(obj, '__dict__') or hasattr(obj, '__slots__'):
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+def bench_memory(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+
+        if tracemalloc:
+            tracemalloc.start()
+        schema = sch.Schematic(filename)
+        if tracemalloc:
+            traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+        print("memory       %10d objects" % len(schema.objects))
+
+        # the source lines kept for saving are shared by all items
+        lines = schema.objects[0]._span[0]
+        print("  source lines %6d x %6d bytes" % (len(lines), deep_sizeof(lines, set()) // len(lines)))
+
+        for kind in ('components', 'wires', 'texts', 'conns', 'noconns'):
+            items = getattr(schema, kind)
+            if items:
+                # strings shared between items of a kind are counted once
+                seen = set([id(lines)])
+                total = sum(deep_sizeof(item, seen) for item in items)
+                print("  %-10s %8d x %6d bytes" % (kind, len(items), total // len(items)))
+        if tracemalloc:
+            print("  total      %12d bytes allocated by load" % traced)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def loop_off_grid(schema, gridsize):
+    """Per item grid check, as CheckSchema.CheckGrid does without NumPy"""
+    bad = []
+    for item in schema.wires:
+        if item.startx % gridsize or item.starty % gridsize:
+            bad.append(item)
+        if item.endx % gridsize or item.endy % gridsize:
+            bad.append(item)
+    for kind in ('components', 'texts', 'conns', 'noconns'):
+        for item in getattr(schema, kind):
+            if item.posx % gridsize or item.posy % gridsize:
+                bad.append(item)
+    return bad
+
+
+def loop_align(schema, gridsize):
+    for item in schema.wires:
+        item.startx -= item.startx % gridsize
+        item.starty -= item.starty % gridsize
+        item.endx -= item.endx % gridsize
+        item.endy -= item.endy % gridsize
+    for kind in ('components', 'texts', 'conns', 'noconns'):
+        for item in getattr(schema, kind):
+            item.posx -= item.posx % gridsize
+            item.posy -= item.posy % gridsize
+
+
+def bench_geometry(args):
+    if not geometry.available():
+        print("geometry: skipped, NumPy is not installed")
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        schema = sch.Schematic(filename)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    build = best_of(lambda: geometry.GeometryStore(schema), args.repeat)
+    store = geometry.GeometryStore(schema)
+    n = len(store)
+
+    before = best_of(lambda: loop_off_grid(schema, 50), args.repeat)
+    after = best_of(lambda: store.off_grid(50), args.repeat)
+    report("grid check", n, "points", before, after)
+
+    before = best_of(lambda: loop_align(schema, 50), args.repeat)
+    after = best_of(lambda: store.align(50), args.repeat)
+    report("align", n, "points", before, after)
+
+    after = best_of(lambda: store.offset(10, 10), args.repeat)
+    print("offset       %10.1f ms" % (after * 1000))
+    print("build        %10.1f ms" % (build * 1000))
+
+    start = timeit.default_timer()
+    changed = store.write_back()
+    print("write back   %10.1f ms  (%d items)" % ((timeit.default_timer() - start) * 1000, len(changed)))
+
+
+def bench_spatial(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        schema = sch.Schematic(filename)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    build = best_of(lambda: spatial.SpatialIndex(schema.objects), args.repeat)
+    index = schema.spatial_index()
+    points = [(w.startx, w.starty) for w in schema.wires[::max(1, len(schema.wires) // 200)]]
+
+    def before():
+        for x, y in points:
+            [item for item in schema.objects if spatial.item_touches_segment(item, x, y, x, y)]
+
+    def after():
+        for x, y in points:
+            index.at(x, y)
+
+    print("spatial      %10d objects, index built in %.1f ms" % (len(schema.objects), build * 1000))
+    report("point query", len(points), "queries", best_of(before, 1), best_of(after, args.repeat))
+
+
+def bench_netlist(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        libname = os.path.join(tmpdir, "bench.lib")
+        make_library(libname, 10)
+        schema = sch.Schematic(filename)
+        lib = render_lib.SymbolLibrary()
+        lib.Load(libname)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    time = best_of(lambda: netlist.Netlist(schema, [lib]), args.repeat)
+    nets = netlist.Netlist(schema, [lib])
+    print("netlist      %10d objects, %d nets in %.1f ms" % (len(schema.objects), len(nets.nets), time * 1000))
+
+
+def legacy_save(schema, filename):
+    """Schematic.save before streaming, the whole file is built in a list"""
+    to_write = [schema.header]
+    to_write += schema.libs
+    to_write += [schema.eelayer, 'EELAYER END\n']
+    to_write += schema.description.raw_data
+    for item in schema.objects:
+        to_write.extend(item.get_text())
+    to_write += ['$EndSCHEMATC\n']
+    with open(filename, 'w') as f:
+        f.writelines(to_write)
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_save(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        schema = sch.Schematic(filename)
+        old = os.path.join(tmpdir, "old.sch")
+        new = os.path.join(tmpdir, "new.sch")
+
+        # move a few items, as a grid fix would
+        for item in schema.wires[:5]:
+            item.set_modified()
+            item.startx += 10
+
+        legacy_save(schema, old)
+        schema.save(new)
+        # unmodified items keep their original formatting
+        assert same_objects(sch.Schematic(old), sch.Schematic(new))
+        print("  %d of %d objects rewritten" % (schema.rewritten, len(schema.objects)))
+
+        def after():
+            # force a write, an unchanged file would be left alone
+            os.remove(new)
+            schema.save(new)
+
+        before = best_of(lambda: legacy_save(schema, old), args.repeat)
+        report("save", len(schema.objects), "objects", before, best_of(after, args.repeat))
+        unchanged = best_of(lambda: schema.save(new), args.repeat)
+        print("  unchanged %11.3f s" % unchanged)
+
+        if tracemalloc:
+            print("  peak memory before %10d bytes" % peak_memory(lambda: legacy_save(schema, old)))
+            print("  peak memory after  %10d bytes" % peak_memory(after))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_iter(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+
+        def before():
+            return len(sch.Schematic(filename).wires)
+
+        def after():
+            return sum(1 for item in sch.iter_items(filename, (sch.Wire,)))
+
+        assert before() == after()
+        report("iter wires", after(), "wires", best_of(before, args.repeat), best_of(after, args.repeat))
+
+        if tracemalloc:
+            print("  peak memory before %10d bytes" % peak_memory(before))
+            print("  peak memory after  %10d bytes" % peak_memory(after))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_cache(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.sch")
+        make_schematic(filename, args.count)
+        parse_cache = cache.ParseCache(os.path.join(tmpdir, "cache"))
+
+        assert same_objects(parse_cache.load(filename), sch.Schematic(filename))
+        assert same_objects(parse_cache.load(filename), sch.Schematic(filename))
+        assert parse_cache.hits == 1
+
+        before = best_of(lambda: sch.Schematic(filename), args.repeat)
+        after = best_of(lambda: parse_cache.load(filename), args.repeat)
+        report("cache hit", len(sch.Schematic(filename).objects), "objects", before, after)
+        print("  entry %12.1f MB, sheet %.1f MB" % (sum(size for used, size, entry in parse_cache.entries()) / 1e6,
+                                                  os.path.getsize(filename) / 1e6))
+
+        # same content, new mtime, as after a fresh checkout
+        mtimes = iter(range(1000000, 2000000, 10))
+        def touched():
+            mtime = next(mtimes)
+            os.utime(filename, (mtime, mtime))
+            parse_cache.load(filename)
+        print("  hit after touch %7.3f s" % best_of(touched, args.repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_kicad_sch(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.kicad_sch")
+        make_kicad_sch(filename, args.count * 100)
+        size = os.path.getsize(filename) / 1e6
+
+        def tokenize():
+            with open(filename) as f:
+                for token in sexpr.tokens(f):
+                    pass
+
+        def build():
+            with open(filename) as f:
+                for expr in sexpr.iter_children(f):
+                    pass
+
+        def load():
+            return kicad_sch.KicadSchematic(filename)
+
+        schema = load()
+        print("kicad_sch    %10.1f MB, %d objects" % (size, len(schema.objects)))
+        for name, func in (("tokenize", tokenize), ("tree", build), ("load", load)):
+            time = best_of(func, args.repeat)
+            print("  %-10s %8.1f MB/s  (%.3f s)" % (name, size / time, time))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_kicad_sym(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.kicad_sym")
+        make_kicad_sym(filename, args.count * 50)
+        size = os.path.getsize(filename) / 1e6
+
+        def load(lazy):
+            lib = render_lib.SymbolLibrary()
+            lib.Load(filename, lazy)
+            return lib
+
+        eager = load(False)
+        lazy = load(True)
+        for a, b in zip(eager.items, lazy.items):
+            assert (a.name, a.alias, a.n_units, len(a.fields), len(a.objects)) == \
+                (b.name, b.alias, b.n_units, len(b.fields), len(b.objects)), a.name
+
+        print("kicad_sym    %10.1f MB, %d symbols" % (size, len(eager.items)))
+        for name, func in (("load", lambda: load(False)), ("lazy load", lambda: load(True))):
+            time = best_of(func, args.repeat)
+            print("  %-10s %8.1f MB/s  (%.3f s)" % (name, size / time, time))
+
+        # an alias in the middle of the library
+        name = eager.items[len(eager.items) // 2].alias[0]
+
+        def lookup():
+            return load(True).find_name(name).objects
+
+        print("  %-10s %8.3f s" % ("lazy, one", best_of(lookup, args.repeat)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_library(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        synthetic = os.path.join(tmpdir, "bench.lib")
+        make_library(synthetic, args.count // 25)
+        lib = render_lib.SymbolLibrary()
+        lib.Load(synthetic)
+        make_dcm(os.path.join(tmpdir, "bench.dcm"), lib)
+
+        for libname in [synthetic] + args.lib:
+            with open(libname) as f:
+                lines = [line.strip() for line in f]
+            bad = split_differences(lines + LIB_SPLIT_CASES)
+            assert not bad, "%s: %r" % (libname, bad[:10])
+
+            def load():
+                lib = render_lib.SymbolLibrary()
+                lib.Load(libname)
+                return lib
+
+            split_lib_line = render_lib.split_lib_line
+            render_lib.split_lib_line = legacy_split_lib_line
+            try:
+                legacy = load()
+                before = best_of(load, args.repeat)
+            finally:
+                render_lib.split_lib_line = split_lib_line
+            lib = load()
+            assert [(i.name, len(i.objects)) for i in lib.items] == \
+                [(i.name, len(i.objects)) for i in legacy.items]
+            after = best_of(load, args.repeat)
+            report(os.path.basename(libname), len(lib.items), "symbols", before, after)
+
+            lazy = render_lib.SymbolLibrary()
+            lazy.Load(libname, lazy=True)
+            assert [(i.name, i.alias, len(i.objects)) for i in lazy.items] == \
+                [(i.name, i.alias, len(i.objects)) for i in lib.items]
+            def load_lazy():
+                render_lib.SymbolLibrary().Load(libname, lazy=True)
+            report("  lazy", len(lib.items), "symbols", after, best_of(load_lazy, args.repeat))
+
+            names = [name for item in lib.items for name in [item.name] + item.alias]
+            assert all(lib.find_name(name) is legacy_find_name(lib, name) for name in names + ['missing'])
+            if libname == synthetic:
+                assert all(item.description == "Description of %s" % item.name for item in lib.items)
+            # a thousand lookups, spread over the library
+            sample = names[::max(1, len(names) // 1000)]
+            before = best_of(lambda: [legacy_find_name(lib, name) for name in sample], args.repeat)
+            after = best_of(lambda: [lib.find_name(name) for name in sample], args.repeat)
+            report("  find_name", len(sample), "lookups", before, after)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_lib_index(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        libname = os.path.join(tmpdir, "bench.lib")
+        make_library(libname, args.count // 25)
+        index = lib_index.LibraryIndex(os.path.join(tmpdir, "index.sqlite"))
+
+        def load_full():
+            lib = render_lib.SymbolLibrary()
+            lib.Load(libname)
+            return lib
+
+        def load_lazy():
+            lib = render_lib.SymbolLibrary()
+            lib.Load(libname, lazy=True)
+            return lib
+
+        def info(lib):
+            return [(i.name, i.alias, i.n_units, i.pin_count()) for i in lib.items]
+
+        miss = best_of(lambda: index.load(libname), 1)
+        hit = index.load(libname)
+        assert index.hits == 1 and not any(item.is_parsed() for item in hit.items)
+        assert info(hit) == info(load_full())
+
+        print("lib_index    %10d symbols, first load %.3f s" % (len(hit.items), miss))
+        for name, func in (("full", load_full), ("lazy", load_lazy), ("index", lambda: index.load(libname))):
+            time = best_of(func, args.repeat)
+            print("  %-10s %8.0f symbols/s  (%.3f s)" % (name, len(hit.items) / time, time))
+        index.close()
+
+        # the same library under several names, as a project with many libraries
+        names = []
+        for j in range(8):
+            names.append(os.path.join(tmpdir, "bench%d.lib" % j))
+            shutil.copy(libname, names[-1])
+        libs = lib_index.load_libraries(names)
+        assert [lib.filename for lib in libs] == names
+
+        def load_fresh():
+            # as the first project of a run, not from the libraries this process loaded
+            lib_index._loaded.clear()
+            return lib_index.load_libraries(names)
+
+        print("8 libraries  %10d symbols" % (len(hit.items) * 8))
+        print("  %-10s %8.3f s" % ("load", best_of(load_fresh, args.repeat)))
+        # what a worker process would add at least, sending the libraries back
+        print("  %-10s %8.3f s" % ("pickled", best_of(lambda: pickle.loads(pickle.dumps(libs, 2)), args.repeat)))
+
+        # as a later project of a batch using the same libraries
+        load_fresh()
+        report("  again", len(hit.items) * 8, "symbols",
+               best_of(load_fresh, args.repeat),
+               best_of(lambda: lib_index.load_libraries(names), args.repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_watch(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # a root sheet with 8 sub-sheets, one of which is edited
+        root = os.path.join(tmpdir, "root.sch")
+        lines = ['EESchema Schematic File Version 2\n']
+        for j in range(8):
+            make_schematic(os.path.join(tmpdir, "sub%d.sch" % j), args.count // 8)
+            lines += ['$Sheet\n', 'S %d 1000 1000 800\n' % (1000 + j * 1500), 'U 5A1B30%02d\n' % j,
+                      'F0 "Sub%d" 60\n' % j, 'F1 "sub%d.sch" 60\n' % j, '$EndSheet\n']
+        with open(root, 'w') as f:
+            f.writelines(lines + ['$EndSCHEMATC\n'])
+        edited = os.path.join(tmpdir, "sub3.sch")
+
+        sheets = hierarchy.Hierarchy(root, jobs=1)
+        kept = sheets.schematics[os.path.abspath(root)]
+        make_schematic(edited, args.count // 4)
+        sheets.reload([edited])
+        assert sheets.parsed == [edited] and sheets.schematics[os.path.abspath(root)] is kept
+        fresh = hierarchy.Hierarchy(root, jobs=1)
+        assert [i.filename for i in sheets.instances()] == [i.filename for i in fresh.instances()]
+        for a, b in zip(sheets.unique_schematics(), fresh.unique_schematics()):
+            assert same_objects(a, b)
+
+        count = sum(len(schema.objects) for schema in fresh.unique_schematics())
+        report("watch", count, "objects",
+               best_of(lambda: hierarchy.Hierarchy(root, jobs=1), args.repeat),
+               best_of(lambda: sheets.reload([edited]), args.repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_resolve(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # 200 libraries spread over 10 search paths, as a project's LibDir
+        paths = [os.path.join(tmpdir, "path%d" % j) for j in range(10)]
+        names = ["lib%03d" % j for j in range(200)]
+        for path in paths:
+            os.mkdir(path)
+        for j, name in enumerate(names):
+            open(os.path.join(paths[j % len(paths)], name + ".lib"), 'w').close()
+
+        def stat_each():
+            return [[os.path.exists(os.path.join(path, name + ".lib")) for path in paths] for name in names]
+
+        def listed():
+            directories = file_util.DirectoryCache()
+            return [[directories.contains(path, name + ".lib") for path in paths] for name in names]
+
+        assert stat_each() == listed()
+        report("resolve", len(names) * len(paths), "lookups",
+               best_of(stat_each, args.repeat), best_of(listed, args.repeat))
+        print("  system calls %8d -> %d" % (len(names) * len(paths), len(paths)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = {
+    'tokenizer': bench_tokenizer,
+    'loader': bench_loader,
+    'memory': bench_memory,
+    'geometry': bench_geometry,
+    'spatial': bench_spatial,
+    'netlist': bench_netlist,
+    'save': bench_save,
+    'iter': bench_iter,
+    'cache': bench_cache,
+    'kicad_sch': bench_kicad_sch,
+    'kicad_sym': bench_kicad_sym,
+    'library': bench_library,
+    'lib_index': bench_lib_index,
+    'watch': bench_watch,
+    'resolve': bench_resolve,
+    }
+
+#
+# main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark schematic/library parsing")
+
+    parser.add_argument("benchmark", nargs="*", help="benchmarks to run: %s" % ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--count", help="size of the synthetic data [100000]", type=int, default=100000)
+    parser.add_argument("--lib", help="library to check and time in the library benchmark, can be repeated",
+                        action="append", default=[])
+    parser.add_argument("--repeat", help="number of timing runs, best is reported [5]", type=int, default=5)
+
+    args = parser.parse_args()
+
+    for name in args.benchmark or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            print("error: unknown benchmark %s" % name)
+            sys.exit(-1)
+        BENCHMARKS[name](args)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of parsed schematic sheets
+
+Each sheet file has one entry in the cache directory: a small pickled
+header recording the path, size, mtime and SHA-1 of the file, followed by
+the pickled sch.Schematic. An entry is used if the file still has the
+same size and mtime, or else the same content hash, so a fresh checkout
+of unchanged files still hits.
+
+The lines of the sheet are not pickled, only the items: on a hit the
+items get the lines again from the file, which is unchanged.
+
+When the directory grows beyond max_bytes or max_entries, the least
+recently used entries are removed.
+
+Loading an entry unpickles it, which can run any code, so the cache
+directory must not be shared with other users. It is created readable
+by its owner only, and where files have owners, entries not owned by
+the current user are ignored.
+"""
+
+import gc
+import hashlib
+import os
+import pickle
+import tempfile
+
+import sch
+from file_util import replace_file
+
+# change when the pickled classes change incompatibly
+CACHE_VERSION = 2
+
+_SUFFIX = '.schcache'
+
+
+def file_digest(filename):
+    """SHA-1 of the content of a file, as hex"""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _owned(f):
+    """Whether the open file f belongs to the current user, always true
+    where files have no owner"""
+    if not hasattr(os, 'getuid'):
+        return True
+    return os.fstat(f.fileno()).st_uid == os.getuid()
+
+
+def _without_gc(func, *args):
+    """Call func with the garbage collector off, which otherwise runs many
+    times over the objects of a large sheet while they are unpickled
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return func(*args)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class ParseCache(object):
+    """
+    Cache of parsed sheets, see load()
+
+    hits and misses count the loads done through this object.
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20, max_entries=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, path):
+        key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def load(self, filename, lazy=False):
+        """Return the Schematic of filename, from the cache if it is unchanged"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        entry = self._entry(path)
+
+        schema = None
+        digest = None
+        try:
+            with open(entry, 'rb') as f:
+                # an entry written by another user may unpickle to anything
+                header = pickle.load(f) if _owned(f) else None
+                if header is not None and \
+                        (header['version'], header['path'], header['lazy'], header['size']) == \
+                        (CACHE_VERSION, path, lazy, st.st_size):
+                    if header['mtime'] != st.st_mtime:
+                        digest = file_digest(path)
+                    if digest is None or digest == header['digest']:
+                        schema = _without_gc(pickle.load, f)
+            if schema is not None and header['lines']:
+                with open(path) as f:
+                    schema.put_lines(f.readlines())
+        except Exception:
+            # missing, stale or unreadable, parse the file again
+            schema = None
+
+        if schema is not None:
+            self.hits += 1
+            schema.filename = filename
+            if digest is not None:
+                # same content, record the new mtime
+                self._store(entry, path, st, digest, lazy, schema)
+            else:
+                self._touch(entry)
+            return schema
+
+        self.misses += 1
+        if digest is None:
+            digest = file_digest(path)
+        schema = sch.load(filename, lazy)
+        if schema.header:
+            self._store(entry, path, st, digest, lazy, schema)
+            self.evict()
+        return schema
+
+    def _touch(self, entry):
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+    def _store(self, entry, path, st, digest, lazy, schema):
+        """Write an entry, a cache which cannot be written is not an error"""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError:
+                # made by another process, or not possible
+                pass
+
+        try:
+            fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        except EnvironmentError:
+            return False
+        lines = schema.take_lines()
+        header = {'version': CACHE_VERSION, 'path': path, 'lazy': lazy, 'lines': bool(lines),
+                  'size': st.st_size, 'mtime': st.st_mtime, 'digest': digest}
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                _without_gc(pickle.dump, schema, f, pickle.HIGHEST_PROTOCOL)
+            replace_file(temp, entry)
+        except EnvironmentError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        finally:
+            schema.put_lines(lines)
+        return True
+
+    def entries(self):
+        """Return (last use, size, file name) of the entries, oldest first"""
+        found = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(_SUFFIX):
+                    entry = os.path.join(self.directory, name)
+                    try:
+                        st = os.stat(entry)
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, st.st_size, entry))
+        found.sort()
+        return found
+
+    def evict(self):
+        """Remove least recently used entries until within the limits"""
+        found = self.entries()
+        total = sum(size for used, size, entry in found)
+        count = len(found)
+        for used, size, entry in found:
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                # already removed by another process
+                pass
+            total -= size
+            count -= 1
+
+    def clear(self):
+        for used, size, entry in self.entries():
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
@@ -1,4 +1,11 @@
 import os
+import sys
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
 
 def change_extension (filename, ext):
     path, filename = os.path.split (filename)
@@ -19,3 +26,62 @@ def get_filename_without_extension (file_path):
     path, filename = os.path.split (file_path)
     basename = os.path.splitext (filename)[0]
     return basename
+
+def replace_file (src, dst):
+    """Rename src over dst in one step"""
+    if hasattr (os, 'replace'):
+        os.replace (src, dst)
+    else:
+        # Python 2, rename does not overwrite on Windows
+        if sys.platform == 'win32' and os.path.exists (dst):
+            os.remove (dst)
+        os.rename (src, dst)
+
+def new_file_mode ():
+    """Mode of a file created by open(), 0666 without the bits of the umask"""
+    # the umask can only be read by setting it
+    mask = os.umask (0)
+    os.umask (mask)
+    return 0o666 & ~mask
+
+def list_dir (directory):
+    """The names in directory, with one system call where possible"""
+    if scandir is None:
+        return os.listdir (directory)
+    return [entry.name for entry in scandir (directory)]
+
+class DirectoryCache (object):
+    """
+    The names in directories, each listed once, to look for many files in
+    a few directories without a stat for each, which is slow on network
+    shares. Names are compared as the file system does, ignoring case on
+    Windows. clear() forgets the listings, e.g. after files were added.
+    """
+    def __init__ (self):
+        self.listings = {}
+
+    def names (self, directory):
+        """The set of names in directory, None if it cannot be listed"""
+        if directory not in self.listings:
+            try:
+                names = set (os.path.normcase (name) for name in list_dir (directory))
+            except OSError:
+                names = None
+            self.listings [directory] = names
+        return self.listings [directory]
+
+    def exists (self, path):
+        """os.path.exists for a directory, without a stat if it was listed"""
+        return self.names (path) is not None or os.path.exists (path)
+
+    def contains (self, directory, name):
+        """os.path.exists (os.path.join (directory, name)), from the listing
+        of directory"""
+        names = self.names (directory or os.curdir)
+        if names is None:
+            # e.g. a directory which may be searched but not listed
+            return os.path.exists (os.path.join (directory, name))
+        return os.path.normcase (name) in names
+
+    def clear (self):
+        self.listings = {}
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar view of the coordinates in a sch.Schematic
+
+All points are held in NumPy arrays so that grid checks, snapping and
+offsets are single vector operations. Changes are copied back to the
+schematic items by write_back().
+
+NumPy is optional, check geometry.available() before using GeometryStore.
+"""
+
+from itertools import chain
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# kind name, Schematic list, coordinate attributes of each point of an item
+KINDS = [
+    ('comp',        'components',   [('posx', 'posy')]),
+    ('text',        'texts',        [('posx', 'posy')]),
+    ('wire',        'wires',        [('startx', 'starty'), ('endx', 'endy')]),
+    ('entry',       'entries',      [('startx', 'starty'), ('endx', 'endy')]),
+    ('junction',    'conns',        [('posx', 'posy')]),
+    ('noconn',      'noconns',      [('posx', 'posy')]),
+    ('bitmap',      'bitmaps',      [('posx', 'posy')]),
+    ('sheet',       'sheets',       [('posx', 'posy')]),
+    ('sheet_pin',   None,           [('posx', 'posy')]),
+    ]
+
+KIND_NAMES = [kind[0] for kind in KINDS]
+
+# sheet pins are only moved by align, like CheckSchema.align_to_grid
+ITEM_KINDS = KIND_NAMES[:-1]
+
+
+def available():
+    return np is not None
+
+
+def sheet_pins(schema):
+    """(sheet, field) for the hierarchical pin fields (F2..) of all sheets"""
+    pins = []
+    for sheet in schema.sheets:
+        for f in sheet.fields:
+            if not f['id'] in ["F0", "F1"]:
+                pins.append((sheet, f))
+    return pins
+
+
+class GeometryStore(object):
+    """
+    Columnar view of all schematic coordinates
+
+    x, y    int64 arrays, one row per point
+    kind    int8 array, index into KIND_NAMES
+    index   int32 array, index of the item in its kind
+    point   int8 array, which point of the item (0 = start, 1 = end)
+    """
+
+    def __init__(self, schema):
+        if np is None:
+            raise ImportError("GeometryStore needs NumPy")
+
+        self.schema = schema
+        self.items = []
+        self.kind_rows = {}
+
+        xys = []
+        kinds = []
+        indexes = []
+        points = []
+        row = 0
+        for kind_id, (name, list_name, attrs) in enumerate(KINDS):
+            if list_name is None:
+                pins = sheet_pins(schema)
+                self.pin_sheets = [sheet for sheet, f in pins]
+                items = [f for sheet, f in pins]
+                coords = chain.from_iterable((int(f['posx']), int(f['posy'])) for f in items)
+            else:
+                items = getattr(schema, list_name)
+                get = attrgetter(*[a for pair in attrs for a in pair])
+                coords = chain.from_iterable(map(get, items))
+
+            n_points = len(attrs)
+            n = len(items) * n_points
+            self.items.append(items)
+            self.kind_rows[name] = (row, row + n)
+            row += n
+
+            if n:
+                xys.append(np.fromiter(coords, dtype=np.int64, count=n * 2).reshape(n, 2))
+                kinds.append(np.full(n, kind_id, dtype=np.int8))
+                indexes.append(np.repeat(np.arange(len(items), dtype=np.int32), n_points))
+                points.append(np.tile(np.arange(n_points, dtype=np.int8), len(items)))
+
+        if xys:
+            xy = np.concatenate(xys)
+            self.kind = np.concatenate(kinds)
+            self.index = np.concatenate(indexes)
+            self.point = np.concatenate(points)
+        else:
+            xy = np.zeros((0, 2), dtype=np.int64)
+            self.kind = np.zeros(0, dtype=np.int8)
+            self.index = np.zeros(0, dtype=np.int32)
+            self.point = np.zeros(0, dtype=np.int8)
+
+        self.x = np.ascontiguousarray(xy[:, 0])
+        self.y = np.ascontiguousarray(xy[:, 1])
+
+        # values currently held by the items, to find what needs writing back
+        self._x0 = self.x.copy()
+        self._y0 = self.y.copy()
+
+    def __len__(self):
+        return len(self.x)
+
+    def mask(self, kinds=None):
+        """Boolean row mask selecting the given kind names, all rows if None"""
+        if kinds is None:
+            return np.ones(len(self.x), dtype=bool)
+        mask = np.zeros(len(self.x), dtype=bool)
+        for name in kinds:
+            start, end = self.kind_rows[name]
+            mask[start:end] = True
+        return mask
+
+    def row_item(self, row):
+        """Return (kind name, item, point) for a row"""
+        kind = int(self.kind[row])
+        return KIND_NAMES[kind], self.items[kind][self.index[row]], int(self.point[row])
+
+    def off_grid(self, gridsize, kinds=ITEM_KINDS):
+        """Rows of points not on the grid, in schematic list order"""
+        bad = ((self.x % gridsize != 0) | (self.y % gridsize != 0)) & self.mask(kinds)
+        return np.flatnonzero(bad)
+
+    def align(self, gridsize, kinds=KIND_NAMES):
+        """Snap points down onto the grid"""
+        mask = self.mask(kinds)
+        self.x[mask] -= self.x[mask] % gridsize
+        self.y[mask] -= self.y[mask] % gridsize
+
+    def offset(self, dx, dy, kinds=ITEM_KINDS):
+        """Move points by (dx, dy)"""
+        mask = self.mask(kinds)
+        self.x[mask] += dx
+        self.y[mask] += dy
+
+    def changed(self):
+        """Rows which differ from the values held by the items"""
+        return np.flatnonzero((self.x != self._x0) | (self.y != self._y0))
+
+    def write_back(self):
+        """Copy changed coordinates back into the schematic items.
+        Returns the list of items changed.
+        """
+        rows = self.changed()
+        changed = []
+
+        # rows are grouped by kind, split them at the kind boundaries
+        bounds = np.searchsorted(rows, [self.kind_rows[name][0] for name in KIND_NAMES] + [len(self.x)])
+        for kind, (name, list_name, attrs) in enumerate(KINDS):
+            sel = rows[bounds[kind]:bounds[kind+1]]
+            if not len(sel):
+                continue
+
+            items = self.items[kind]
+            last = None
+            for index, point, x, y in zip(self.index[sel].tolist(),
+                                          self.point[sel].tolist(),
+                                          self.x[sel].tolist(),
+                                          self.y[sel].tolist()):
+                item = items[index]
+                ax, ay = attrs[point]
+                if list_name is None:
+                    item[ax] = str(x)
+                    item[ay] = str(y)
+                    # the pin is a field of the sheet
+                    item = self.pin_sheets[index]
+                    item.set_modified()
+                else:
+                    item.set_modified()
+                    setattr(item, ax, x)
+                    setattr(item, ay, y)
+                if item is not last:
+                    changed.append(item)
+                    last = item
+
+        self._x0[rows] = self.x[rows]
+        self._y0[rows] = self.y[rows]
+
+        self.schema.items_moved(changed)
+        return changed
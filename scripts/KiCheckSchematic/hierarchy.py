@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""
+Loader for hierarchical schematics
+
+The root sheet and every sheet file referenced by a $Sheet F1 field are
+parsed once each, however many times they are instantiated, and the
+files found at each level of the hierarchy are parsed in parallel in a
+process pool. The result is a tree of SheetInstance, instances of the
+same file share one sch.Schematic.
+
+reload() loads the hierarchy again after some of its files changed,
+parsing only those, for --watch.
+"""
+
+import multiprocessing
+import os
+
+import sch
+
+
+def sheet_filename(sheet):
+    """File name from the F1 field of a $Sheet"""
+    for f in sheet.fields:
+        if f['id'] == "F1":
+            return f['value'].strip('"')
+    return None
+
+
+def sheet_name(sheet):
+    """Sheet name from the F0 field of a $Sheet"""
+    for f in sheet.fields:
+        if f['id'] == "F0":
+            return f['value'].strip('"')
+    return ""
+
+
+def _parse(args):
+    filename, lazy, cache = args
+    if cache is not None:
+        return cache.load(filename, lazy)
+    return sch.load(filename, lazy)
+
+
+class SheetInstance(object):
+    """
+    One use of a sheet file in the hierarchy
+
+    path    the sheet path, made of the $Sheet unique ids, "/" for the root
+    sheet   the $Sheet item in the parent, None for the root
+    schema  the sch.Schematic, shared with other instances of the file
+    """
+
+    def __init__(self, name, filename, path, schema, parent=None, sheet=None):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.schema = schema
+        self.parent = parent
+        self.sheet = sheet
+        self.children = []
+
+    def walk(self):
+        """Yield this instance and all instances below it, depth first"""
+        yield self
+        for child in self.children:
+            for instance in child.walk():
+                yield instance
+
+
+class Hierarchy(object):
+    """
+    Load a root sheet and all its sub-sheets
+
+    jobs    number of worker processes, None for one per CPU, 1 to parse
+            in this process
+    lazy    passed on to sch.Schematic
+    cache   a cache.ParseCache to load sheets through, None to parse them all
+    """
+
+    def __init__(self, filename, jobs=None, lazy=False, cache=None):
+        self.filename = filename
+        self.jobs = jobs
+        self.lazy = lazy
+        self.cache = cache
+
+        # absolute file name -> Schematic
+        self.schematics = {}
+        self.reload()
+
+    def reload(self, changed=()):
+        """
+        Load the hierarchy again after the files in changed have changed.
+        Only these and sheet files not loaded before are parsed, the
+        other Schematics are kept. The files parsed are in self.parsed.
+        """
+        changed = set(os.path.abspath(filename) for filename in changed)
+        previous = dict((key, schema) for key, schema in self.schematics.items()
+                        if schema is not None and key not in changed)
+        self.schematics = {}
+        self.parsed = []
+
+        # (parent file, sheet file) for sheet files which do not exist,
+        # and sheet instances not loaded because they include themselves
+        self.missing = []
+        self.recursive = []
+
+        self._load_files(previous)
+
+        key = os.path.abspath(self.filename)
+        self.root = SheetInstance("", self.filename, "/", self.schematics[key])
+        self._build(self.root, [key])
+        self._add_symbol_instances()
+
+    def _resolve(self, parent_filename, name):
+        """Sheet file names are relative to the project, else to the parent sheet"""
+        for base in (os.path.dirname(self.filename), os.path.dirname(parent_filename)):
+            path = os.path.join(base, name)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _children(self, filename, schema):
+        """Yield ($Sheet, resolved file name or None) for the sub-sheets of a sheet"""
+        for sheet in schema.sheets:
+            name = sheet_filename(sheet)
+            if name:
+                yield sheet, self._resolve(filename, name)
+
+    def _parse_all(self, filenames):
+        work = [(filename, self.lazy, self.cache) for filename in filenames]
+        if self.jobs == 1 or len(work) < 2:
+            return [_parse(w) for w in work]
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.jobs)
+        return self._pool.map(_parse, work)
+
+    def _load_files(self, previous):
+        self._pool = None
+        try:
+            level = [self.filename]
+            while level:
+                todo = []
+                for filename in level:
+                    key = os.path.abspath(filename)
+                    if key in previous:
+                        self.schematics[key] = previous[key]
+                    else:
+                        todo.append(filename)
+                for filename, schema in zip(todo, self._parse_all(todo)):
+                    self.schematics[os.path.abspath(filename)] = schema
+                self.parsed += todo
+
+                # files first referenced at this level
+                next_level = []
+                for filename in level:
+                    for sheet, child in self._children(filename, self.schematics[os.path.abspath(filename)]):
+                        if child is None:
+                            self.missing.append((filename, sheet_filename(sheet)))
+                            continue
+                        key = os.path.abspath(child)
+                        if key not in self.schematics:
+                            self.schematics[key] = None
+                            next_level.append(child)
+                level = next_level
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def _build(self, instance, stack):
+        for sheet, child in self._children(instance.filename, instance.schema):
+            if child is None:
+                continue
+            key = os.path.abspath(child)
+            path = instance.path + sheet.unique_id + "/"
+            if key in stack:
+                self.recursive.append((instance.filename, child))
+                continue
+            sub = SheetInstance(sheet_name(sheet), child, path, self.schematics[key], instance, sheet)
+            instance.children.append(sub)
+            self._build(sub, stack + [key])
+
+    def _add_symbol_instances(self):
+        """A KiCad 6 root sheet has the references of the symbols of all
+        sheet instances, add them to the components of the sub-sheets"""
+        symbol_instances = getattr(self.root.schema, 'symbol_instances', None)
+        if not symbol_instances:
+            return
+        import kicad_sch
+        for instance in self.root.walk():
+            kicad_sch.add_references(instance.schema, symbol_instances.get(instance.path, ()))
+
+    def files(self):
+        """The sheet files loaded, and where the missing ones are looked for"""
+        files = [self.filename] + sorted(self.schematics)
+        for parent, name in self.missing:
+            for base in (os.path.dirname(self.filename), os.path.dirname(parent)):
+                files.append(os.path.join(base, name))
+        return files
+
+    def instances(self):
+        """All sheet instances, depth first from the root"""
+        return list(self.root.walk())
+
+    def unique_schematics(self):
+        """Each Schematic once, in the order first reached from the root"""
+        seen = set()
+        found = []
+        for instance in self.root.walk():
+            if id(instance.schema) not in seen:
+                seen.add(id(instance.schema))
+                found.append(instance.schema)
+        return found
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reader for KiCad 6 .kicad_sch schematic sheets
+
+The file is parsed with sexpr.iter_children, one top level item at a
+time, and each item is mapped onto the classes of sch, so that code
+written for legacy sheets works unchanged:
+
+    symbol              sch.Component
+    sheet               sch.Sheet, pins as fields F2..
+    wire, bus           sch.Wire, type1 "Wire" or "Bus"
+    polyline            sch.Wire, type1 "Notes", one per segment
+    bus_entry           sch.Entry
+    junction            sch.Connection
+    no_connect          sch.NoConnect
+    text, label, global_label, hierarchical_label
+                        sch.Text, type Notes, Label, GLabel, HLabel
+    image               sch.Bitmap, without the image data
+
+Coordinates are converted from mm to mils. Field values are quoted as in
+legacy files.
+
+The references of the symbols of all sheets are in the symbol_instances
+of the root sheet, they are added as AR references to the components of
+the root sheet when it is read, and to those of the sub-sheets by
+hierarchy.Hierarchy once all sheets are loaded.
+"""
+
+import sys
+
+import sch
+import sexpr
+from sexpr import find, find_all, quote
+
+
+MM_PER_MIL = 0.0254
+
+# label shape -> legacy shape, also the sheet pin IOState letter
+_SHAPES = {
+    'input':            'Input',
+    'output':           'Output',
+    'bidirectional':    'BiDi',
+    'tri_state':        '3State',
+    'passive':          'UnSpc',
+    }
+
+# sheet pin angle -> side of the sheet
+_SIDES = {0: 'R', 90: 'T', 180: 'L', 270: 'B'}
+
+
+def mils(value):
+    """Convert a length in mm, as written in the file, to int mils"""
+    return int(round(float(value) / MM_PER_MIL))
+
+
+def _at(expr):
+    """Return (x, y, angle) of the (at x y angle) of expr, x y in mils"""
+    at = find(expr, 'at')
+    if at is None:
+        return 0, 0, 0
+    angle = int(round(float(at[3]))) % 360 if len(at) > 3 else 0
+    return mils(at[1]), mils(at[2]), angle
+
+
+def _pts(expr):
+    """(x, y) in mils of the (pts (xy x y) ...) of expr"""
+    pts = find(expr, 'pts')
+    if pts is None:
+        return []
+    return [(mils(xy[1]), mils(xy[2])) for xy in find_all(pts, 'xy')]
+
+
+class Effects(object):
+    """Text size (mils), style and justification from (effects ...)"""
+
+    def __init__(self, expr):
+        self.size = 50
+        self.italic = False
+        self.bold = False
+        self.hjust = 'C'
+        self.vjust = 'C'
+        self.hide = False
+
+        effects = find(expr, 'effects')
+        if effects is None:
+            return
+        self.hide = 'hide' in effects
+        font = find(effects, 'font')
+        if font is not None:
+            size = find(font, 'size')
+            if size is not None:
+                self.size = mils(size[1])
+            self.italic = 'italic' in font
+            self.bold = 'bold' in font
+        justify = find(effects, 'justify')
+        if justify is not None:
+            for value in justify[1:]:
+                if value in ('left', 'right'):
+                    self.hjust = value[0].upper()
+                elif value in ('top', 'bottom'):
+                    self.vjust = value[0].upper()
+
+
+def transform(angle, mirror):
+    """Legacy orientation matrix (a, b, c, d) of a symbol rotated by angle
+    (degrees, counterclockwise) and mirrored about axis 'x', 'y' or None.
+    A library pin at (px, py), Y up, is placed at
+    (posx + a*px + b*py, posy + c*px + d*py).
+    """
+    # library Y up to sheet Y down
+    a, b, c, d = 1, 0, 0, -1
+    for i in range((angle // 90) % 4):
+        # quarter turn counterclockwise on the sheet: (x, y) -> (y, -x)
+        a, b, c, d = c, d, -a, -b
+    if mirror == 'x':
+        c, d = -c, -d
+    elif mirror == 'y':
+        a, b = -a, -b
+    return a, b, c, d
+
+
+def _new(cls):
+    """An item of cls, its attributes to be set by the caller"""
+    return cls.__new__(cls)
+
+
+def make_component(expr):
+    comp = _new(sch.Component)
+    comp._source = None
+    x, y, angle = _at(expr)
+    mirror = find(expr, 'mirror')
+
+    properties = find_all(expr, 'property')
+    ref = ''
+    fields = []
+    for prop in properties:
+        name, value = prop[1], prop[2]
+        id_expr = find(prop, 'id')
+        field_id = int(id_expr[1]) if id_expr is not None else len(fields)
+        if field_id == 0:
+            ref = value
+        fx, fy, fangle = _at(prop)
+        effects = Effects(prop)
+        fields.append((field_id, {
+            'id': str(field_id),
+            'ref': quote(value),
+            'orient': 'V' if fangle in (90, 270) else 'H',
+            'posx': str(fx),
+            'posy': str(fy),
+            'size': str(effects.size),
+            'attributes': '0001' if effects.hide else '0000',
+            'hjust': effects.hjust,
+            'props': effects.vjust + ('I' if effects.italic else 'N') + ('B' if effects.bold else 'N'),
+            'name': quote(name) if field_id > 3 else '',
+            }))
+    fields.sort(key=lambda f: f[0])
+
+    lib_id = find(expr, 'lib_id')
+    unit = find(expr, 'unit')
+    convert = find(expr, 'convert')
+    uuid = find(expr, 'uuid')
+
+    comp.labels = {'name': lib_id[1] if lib_id else '', 'ref': ref}
+    comp.unit = {'unit': unit[1] if unit else '1',
+                 'convert': convert[1] if convert else '1',
+                 'time_stamp': uuid[1] if uuid else ''}
+    comp.references = []
+    comp.fields = [f for field_id, f in fields]
+    comp.posx = x
+    comp.posy = y
+    comp.rotation = "%d %d %d %d" % transform(angle, mirror[1] if mirror else None)
+    return comp
+
+
+def make_sheet(expr):
+    sheet = _new(sch.Sheet)
+    sheet._source = None
+    sheet.posx, sheet.posy, angle = _at(expr)
+    size = find(expr, 'size')
+    sheet.width = mils(size[1]) if size else 0
+    sheet.height = mils(size[2]) if size else 0
+    uuid = find(expr, 'uuid')
+    sheet.unique_id = uuid[1] if uuid else ''
+
+    name = filename = ''
+    name_size = file_size = 50
+    for prop in find_all(expr, 'property'):
+        if prop[1] == 'Sheet name':
+            name, name_size = prop[2], Effects(prop).size
+        elif prop[1] == 'Sheet file':
+            filename, file_size = prop[2], Effects(prop).size
+
+    # as read from "F0 name size", the size lands in IOState
+    fields = [
+        {'id': 'F0', 'value': quote(name), 'IOState': str(name_size),
+         'side': '', 'posx': '', 'posy': '', 'size': ''},
+        {'id': 'F1', 'value': quote(filename), 'IOState': str(file_size),
+         'side': '', 'posx': '', 'posy': '', 'size': ''},
+        ]
+    for pin in find_all(expr, 'pin'):
+        x, y, angle = _at(pin)
+        shape = _SHAPES.get(pin[2], 'UnSpc') if len(pin) > 2 and type(pin[2]) is not list else 'UnSpc'
+        fields.append({
+            'id': 'F%d' % len(fields),
+            'value': quote(pin[1]),
+            'IOState': shape[0] if shape != '3State' else 'T',
+            'side': _SIDES.get(angle, 'L'),
+            'posx': str(x),
+            'posy': str(y),
+            'size': str(Effects(pin).size),
+            })
+    sheet.fields = fields
+    return sheet
+
+
+def make_wire(expr, type1, start, end):
+    wire = _new(sch.Wire)
+    wire.type1 = type1
+    wire.type2 = 'Line'
+    wire.startx, wire.starty = start
+    wire.endx, wire.endy = end
+    return wire
+
+
+def make_entry(expr):
+    entry = _new(sch.Entry)
+    entry.type1 = 'Wire'
+    entry.type2 = 'Line'
+    entry.startx, entry.starty, angle = _at(expr)
+    size = find(expr, 'size')
+    entry.endx = entry.startx + (mils(size[1]) if size else 0)
+    entry.endy = entry.starty + (mils(size[2]) if size else 0)
+    return entry
+
+
+def make_point(cls, expr):
+    item = _new(cls)
+    item.posx, item.posy, angle = _at(expr)
+    return item
+
+
+def make_text(expr, text_type):
+    text = _new(sch.Text)
+    text.type = text_type
+    text.posx, text.posy, angle = _at(expr)
+    text.orientation = str(angle // 90 % 4)
+    effects = Effects(expr)
+    text.textsize = str(effects.size)
+    shape = find(expr, 'shape')
+    text.shape = _SHAPES.get(shape[1], 'UnSpc') if shape else ''
+    text.italic = effects.italic
+    text.bold = effects.bold
+    # legacy files escape newlines in the text line
+    text.data = expr[1].replace('\n', '\\n') if len(expr) > 1 else ''
+    return text
+
+
+def make_bitmap(expr):
+    bitmap = _new(sch.Bitmap)
+    bitmap.posx, bitmap.posy, angle = _at(expr)
+    scale = find(expr, 'scale')
+    bitmap.scale = scale[1] if scale else '1.0'
+    bitmap.bitmap_data = []
+    return bitmap
+
+
+def add_references(schema, references):
+    """Add references, a list of (symbol uuid, AR reference) of one sheet
+    instance, to the components of schema, each once"""
+    for time_stamp, reference in references:
+        comp = schema.component_by_time_stamp(time_stamp)
+        if comp is not None and reference not in comp.references:
+            comp.references.append(reference)
+
+
+class KicadSchematic(sch.Schematic):
+    """
+    A KiCad 6 schematic sheet, with the same lists of items as
+    sch.Schematic. Items are not parsed lazily, lazy is accepted for
+    compatibility. Saving is not supported.
+    """
+
+    def __init__(self, filename, lazy=False):
+        self.filename = filename
+        self.lazy = lazy
+        self.header = None
+        self.libs = []
+        self.eelayer = None
+        self.description = None
+        self.version = None
+        self.generator = None
+        # sheet instance path -> [(symbol uuid, AR reference)]
+        self.symbol_instances = {}
+        self._init_items()
+
+        with open(filename) as f:
+            first = f.read(256)
+            if not first.lstrip().startswith('(kicad_sch'):
+                sys.stderr.write('The file is not a KiCad 6 Schematic File\n')
+                return
+            f.seek(0)
+            self.header = 'kicad_sch'
+            for expr in sexpr.iter_children(f):
+                if type(expr) is list and expr:
+                    handler = self._HANDLERS.get(expr[0])
+                    if handler is not None:
+                        handler(self, expr)
+
+    def iter_lines(self):
+        """Not supported, the lines of sch would be legacy text"""
+        raise NotImplementedError('KiCad 6 sheets cannot be written')
+
+    def save(self, filename=None):
+        """Not supported, nothing is written. Returns False"""
+        sys.stderr.write('Saving a KiCad 6 Schematic File is not supported: %s\n'
+                         % (filename or self.filename))
+        return False
+
+    def _load_version(self, expr):
+        self.version = expr[1]
+
+    def _load_generator(self, expr):
+        self.generator = expr[1]
+
+    def _load_symbol(self, expr):
+        comp = make_component(expr)
+        self._add(comp, self.components)
+        self._index(comp)
+
+    def _load_symbol_instances(self, expr):
+        # (path "/sheet uuid/symbol uuid" (reference "R1") (unit 1) ...),
+        # only in the root sheet, for the symbols of all sheets
+        for path in find_all(expr, 'path'):
+            sheet_path, _, time_stamp = path[1].rpartition('/')
+            ref = find(path, 'reference')
+            unit = find(path, 'unit')
+            self.symbol_instances.setdefault(sheet_path + '/', []).append((time_stamp, {
+                'path': 'Path=%s' % quote(path[1]),
+                'ref': 'Ref=%s' % quote(ref[1] if ref else ''),
+                'part': 'Part=%s' % quote(unit[1] if unit else '1'),
+                }))
+        add_references(self, self.symbol_instances.get('/', ()))
+
+    def _load_sheet(self, expr):
+        self._add(make_sheet(expr), self.sheets)
+
+    def _load_wire(self, expr):
+        pts = _pts(expr)
+        if len(pts) >= 2:
+            self._add(make_wire(expr, 'Wire', pts[0], pts[-1]), self.wires)
+
+    def _load_bus(self, expr):
+        pts = _pts(expr)
+        if len(pts) >= 2:
+            self._add(make_wire(expr, 'Bus', pts[0], pts[-1]), self.wires)
+
+    def _load_polyline(self, expr):
+        pts = _pts(expr)
+        for start, end in zip(pts, pts[1:]):
+            self._add(make_wire(expr, 'Notes', start, end), self.wires)
+
+    def _load_bus_entry(self, expr):
+        self._add(make_entry(expr), self.entries)
+
+    def _load_junction(self, expr):
+        self._add(make_point(sch.Connection, expr), self.conns)
+
+    def _load_no_connect(self, expr):
+        self._add(make_point(sch.NoConnect, expr), self.noconns)
+
+    def _load_text(self, expr):
+        self._add(make_text(expr, 'Notes'), self.texts)
+
+    def _load_label(self, expr):
+        self._add(make_text(expr, 'Label'), self.texts)
+
+    def _load_global_label(self, expr):
+        self._add(make_text(expr, 'GLabel'), self.texts)
+
+    def _load_hierarchical_label(self, expr):
+        self._add(make_text(expr, 'HLabel'), self.texts)
+
+    def _load_image(self, expr):
+        self._add(make_bitmap(expr), self.bitmaps)
+
+    # keyword of a top level item -> loader
+    _HANDLERS = {
+        'version':              _load_version,
+        'generator':            _load_generator,
+        'symbol':               _load_symbol,
+        'symbol_instances':     _load_symbol_instances,
+        'sheet':                _load_sheet,
+        'wire':                 _load_wire,
+        'bus':                  _load_bus,
+        'polyline':             _load_polyline,
+        'bus_entry':            _load_bus_entry,
+        'junction':             _load_junction,
+        'no_connect':           _load_no_connect,
+        'text':                 _load_text,
+        'label':                _load_label,
+        'global_label':         _load_global_label,
+        'hierarchical_label':   _load_hierarchical_label,
+        'image':                _load_image,
+        }
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reader for KiCad 6 .kicad_sym symbol libraries
+
+Symbols are mapped onto the classes of render_lib, so that code written
+for legacy .lib files works unchanged:
+
+    symbol              KicadSymbol, a render_lib.SchSymbol
+    property            render_lib.Field, ki_description, ki_keywords and
+                        ki_fp_filters fill description, keywords, fplist
+    pin                 render_lib.Pin
+    arc, circle, polyline, bezier, rectangle, text
+                        render_lib.Arc, Circle, Polyline, Rectangle, Text
+    extends             the derived symbol is an alias of its parent
+
+Coordinates are converted from mm to mils, unit and convert come from the
+"name_unit_convert" names of the sub-symbols.
+
+With lazy=True only the lines where symbols start and end are found, by
+following the parenthesis depth line by line, and each symbol is parsed
+when one of its attributes other than the name is first used. This
+relies on each symbol starting on a line of its own, as KiCad writes
+them.
+
+read_lib_table() reads a sym-lib-table, which maps the library nicknames
+used by KiCad 6 projects onto library files.
+"""
+
+import itertools
+import math
+import os
+import re
+import sys
+
+import render_lib
+import sexpr
+from kicad_sch import mils, Effects
+from sexpr import find, find_all, quote
+
+
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+_SYMBOL_RE = re.compile(r'\s*\(symbol\s+"((?:[^"\\]|\\.)*)"')
+_EXTENDS_RE = re.compile(r'\(extends\s+"((?:[^"\\]|\\.)*)"')
+_UNITS_RE = re.compile(r'\(symbol\s+"(?:[^"\\]|\\.)*?_(\d+)_\d+"')
+
+_ELEC_TYPES = {
+    'input':            'I',
+    'output':           'O',
+    'bidirectional':    'B',
+    'tri_state':        'T',
+    'passive':          'P',
+    'unspecified':      'U',
+    'power_in':         'W',
+    'power_out':        'w',
+    'open_collector':   'C',
+    'open_emitter':     'E',
+    'no_connect':       'N',
+    'free':             'N',
+    }
+
+_PIN_SHAPES = {
+    'line':             '',
+    'inverted':         'I',
+    'clock':            'C',
+    'inverted_clock':   'IC',
+    'input_low':        'L',
+    'clock_low':        'CL',
+    'output_low':       'V',
+    'edge_clock_high':  'F',
+    'non_logic':        'X',
+    }
+
+# pin angle -> direction the pin points from its end to the body
+_PIN_DIRS = {0: 'R', 90: 'U', 180: 'L', 270: 'D'}
+
+_FILLS = {'none': 'N', 'outline': 'F', 'background': 'f'}
+
+_UNIT_RE = re.compile(r'_(\d+)_(\d+)$')
+
+
+def _xy(expr, keyword):
+    """(x, y) in mils of the (keyword x y) in expr"""
+    point = find(expr, keyword)
+    if point is None:
+        return 0, 0
+    return mils(point[1]), mils(point[2])
+
+
+def _stroke_fill(obj, expr):
+    stroke = find(expr, 'stroke')
+    width = find(stroke, 'width') if stroke is not None else None
+    obj.thickness = mils(width[1]) if width is not None else 0
+    fill = find(expr, 'fill')
+    fill_type = find(fill, 'type') if fill is not None else None
+    obj.fill = _FILLS.get(fill_type[1], 'N') if fill_type is not None else 'N'
+
+
+def _angle(x, y):
+    """Angle of (x, y) in tenths of a degree, -1800..1800"""
+    return int(round(math.degrees(math.atan2(y, x)) * 10))
+
+
+def make_pin(parent, expr, unit, convert):
+    pin = render_lib.Pin(parent)
+    x, y, angle = _at(expr)
+    length = find(expr, 'length')
+    name = find(expr, 'name')
+    number = find(expr, 'number')
+
+    pin.name = name[1] if name is not None else '~'
+    pin.num = number[1] if number is not None else ''
+    pin.posx = x
+    pin.posy = y
+    pin.length = mils(length[1]) if length is not None else 0
+    pin.dir = _PIN_DIRS.get(angle, 'R')
+    pin.name_size = Effects(name).size if name is not None else 50
+    pin.num_size = Effects(number).size if number is not None else 50
+    pin.unit = unit
+    pin.convert = convert
+    pin.elec_type = _ELEC_TYPES.get(expr[1], 'U') if len(expr) > 1 else 'U'
+    shape = _PIN_SHAPES.get(expr[2], '') if len(expr) > 2 and type(expr[2]) is not list else ''
+    pin.pin_type = 'N' + shape if 'hide' in expr else shape
+    return pin
+
+
+def _at(expr):
+    at = find(expr, 'at')
+    if at is None:
+        return 0, 0, 0
+    angle = int(round(float(at[3]))) % 360 if len(at) > 3 else 0
+    return mils(at[1]), mils(at[2]), angle
+
+
+def make_arc(parent, expr, unit, convert):
+    arc = render_lib.Arc(parent)
+    arc.startx, arc.starty = _xy(expr, 'start')
+    arc.endx, arc.endy = _xy(expr, 'end')
+    mid = find(expr, 'mid')
+    radius = find(expr, 'radius')
+
+    if mid is not None:
+        # centre of the circle through start, mid and end
+        ax, ay = arc.startx, arc.starty
+        bx, by = mils(mid[1]), mils(mid[2])
+        cx, cy = arc.endx, arc.endy
+        d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if d:
+            a2 = ax * ax + ay * ay
+            b2 = bx * bx + by * by
+            c2 = cx * cx + cy * cy
+            px = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+            py = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+        else:
+            px, py = (ax + cx) / 2.0, (ay + cy) / 2.0
+        arc.posx = int(round(px))
+        arc.posy = int(round(py))
+        arc.radius = int(round(math.hypot(ax - px, ay - py)))
+    elif radius is not None:
+        # older files: (radius (at x y) (length r) (angles a b))
+        arc.posx, arc.posy = _xy(radius, 'at')
+        length = find(radius, 'length')
+        arc.radius = mils(length[1]) if length is not None else 0
+    else:
+        arc.posx, arc.posy, arc.radius = arc.startx, arc.starty, 0
+
+    arc.start_angle = _angle(arc.startx - arc.posx, arc.starty - arc.posy)
+    arc.end_angle = _angle(arc.endx - arc.posx, arc.endy - arc.posy)
+    arc.unit = unit
+    arc.convert = convert
+    _stroke_fill(arc, expr)
+    return arc
+
+
+def make_circle(parent, expr, unit, convert):
+    circle = render_lib.Circle(parent)
+    circle.posx, circle.posy = _xy(expr, 'center')
+    radius = find(expr, 'radius')
+    circle.radius = mils(radius[1]) if radius is not None else 0
+    circle.unit = unit
+    circle.convert = convert
+    _stroke_fill(circle, expr)
+    return circle
+
+
+def make_polyline(parent, expr, unit, convert):
+    polyline = render_lib.Polyline(parent)
+    pts = find(expr, 'pts')
+    polyline.points = [(mils(xy[1]), mils(xy[2])) for xy in find_all(pts, 'xy')] if pts is not None else []
+    polyline.unit = unit
+    polyline.convert = convert
+    _stroke_fill(polyline, expr)
+    return polyline
+
+
+def make_rectangle(parent, expr, unit, convert):
+    rect = render_lib.Rectangle(parent)
+    rect.startx, rect.starty = _xy(expr, 'start')
+    rect.endx, rect.endy = _xy(expr, 'end')
+    rect.unit = unit
+    rect.convert = convert
+    _stroke_fill(rect, expr)
+    return rect
+
+
+def make_text(parent, expr, unit, convert):
+    text = render_lib.Text(parent)
+    at = find(expr, 'at')
+    text.posx, text.posy = (mils(at[1]), mils(at[2])) if at is not None else (0, 0)
+    # tenths of a degree, as in .lib files
+    angle = float(at[3]) if at is not None and len(at) > 3 else 0
+    text.direction = int(round(angle if angle > 360 else angle * 10))
+    effects = Effects(expr)
+    text.size = effects.size
+    text.unit = unit
+    text.convert = convert
+    text.text = expr[1] if len(expr) > 1 else ''
+    text.italic = effects.italic
+    text.bold = effects.bold
+    text.hjust = effects.hjust
+    text.vjust = effects.vjust
+    return text
+
+
+_GRAPHICS = {
+    'pin':          make_pin,
+    'arc':          make_arc,
+    'circle':       make_circle,
+    'polyline':     make_polyline,
+    'bezier':       make_polyline,
+    'rectangle':    make_rectangle,
+    'text':         make_text,
+    }
+
+
+def make_field(parent, expr, number):
+    field = render_lib.Field(parent)
+    x, y, angle = _at(expr)
+    effects = Effects(expr)
+    # like .lib files, fields other than reference and value keep their quotes
+    field.fieldname = quote(expr[1]) if number > 3 else ""
+    field.value = expr[2] if number < 2 else quote(expr[2])
+    field.posx = x
+    field.posy = y
+    field.size = effects.size
+    field.orient = 'V' if angle in (90, 270) else 'H'
+    field.visible = not effects.hide
+    field.hjust = effects.hjust
+    field.vjust = effects.vjust
+    return field
+
+
+class KicadSymbol(render_lib.LazySymbol):
+    """
+    A symbol of a .kicad_sym library, source is the parsed expression, or
+    the lines of the library or its file name, with the range of lines of
+    the symbol
+    """
+
+    def load_source(self, source):
+        if type(source) is list:
+            expr = source
+        else:
+            lines, start, end = source
+            if isinstance(lines, list):
+                expr = sexpr.parse(lines[start:end])
+            else:
+                with open(lines) as f:
+                    expr = sexpr.parse(itertools.islice(f, start, end))
+
+        self.text_offset = 40
+        self.draw_pinnums = find(expr, 'pin_numbers') is None or 'hide' not in find(expr, 'pin_numbers')
+        pin_names = find(expr, 'pin_names')
+        self.draw_pinnames = pin_names is None or 'hide' not in pin_names
+        if pin_names is not None and find(pin_names, 'offset') is not None:
+            self.text_offset = mils(find(pin_names, 'offset')[1])
+        self.units_locked = find(expr, 'unit_locked') is not None
+        self.flag = 'P' if find(expr, 'power') is not None else 'N'
+
+        properties = find_all(expr, 'property')
+        for prop in properties:
+            key, value = prop[1], prop[2]
+            if key == 'ki_description':
+                self.description = value
+            elif key == 'ki_keywords':
+                self.keywords = value
+            elif key == 'ki_fp_filters':
+                self.fplist = value.split()
+            else:
+                if key == 'Datasheet':
+                    self.datasheet = value
+                self.fields.append(make_field(self, prop, len(self.fields)))
+
+        self.n_units = 1
+        for sub in find_all(expr, 'symbol'):
+            m = _UNIT_RE.search(sub[1])
+            unit, convert = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+            self.n_units = max(self.n_units, unit)
+            for item in sub[2:]:
+                if type(item) is list and item:
+                    make = _GRAPHICS.get(item[0])
+                    if make is not None:
+                        self.objects.append(make(self, item, unit, convert))
+
+
+def scan_symbols(lines):
+    """Yield (name, parent name or None, start, end, n_units) for the top
+    level symbols in lines, without parsing them
+    """
+    depth = 0
+    start = None
+    for i, line in enumerate(lines):
+        counted = _STRING_RE.sub('""', line) if '"' in line else line
+        if depth == 1 and start is None:
+            m = _SYMBOL_RE.match(line)
+            if m:
+                start = i
+                name = sexpr.unescape(m.group(1))
+        depth += counted.count('(') - counted.count(')')
+        if start is not None and depth <= 1:
+            text = ''.join(lines[start:i + 1])
+            m = _EXTENDS_RE.search(text)
+            extends = sexpr.unescape(m.group(1)) if m else None
+            # the units are the nested symbols, e.g. (symbol "R_1_1"
+            n_units = 1
+            for unit in _UNITS_RE.findall(text, _SYMBOL_RE.match(text).end()):
+                n_units = max(n_units, int(unit))
+            yield name, extends, start, i + 1, n_units
+            start = None
+
+
+def load_symbols(filename, lazy=False):
+    """Return the KicadSymbol list of a .kicad_sym file. Derived symbols
+    become aliases of their parent symbol.
+    """
+    symbols = []
+    derived = []
+
+    with open(filename) as f:
+        if lazy:
+            lines = f.readlines()
+            for name, extends, start, end, n_units in scan_symbols(lines):
+                if extends is not None:
+                    derived.append((name, extends))
+                else:
+                    symbol = KicadSymbol(name, [], (lines, start, end))
+                    symbol.n_units = n_units
+                    symbols.append(symbol)
+        else:
+            for expr in sexpr.iter_children(f):
+                if type(expr) is list and expr and expr[0] == 'symbol':
+                    extends = find(expr, 'extends')
+                    if extends is not None:
+                        derived.append((expr[1], extends[1]))
+                    else:
+                        symbol = KicadSymbol(expr[1], [], expr)
+                        symbol.parse()
+                        symbols.append(symbol)
+
+    by_name = dict((symbol.name, symbol) for symbol in symbols)
+    for name, parent in derived:
+        if parent in by_name:
+            by_name[parent].alias.append(name)
+    return symbols
+
+
+# ${NAME} or $(NAME) in a library table
+_VAR_RE = re.compile(r'\$\{(\w+)\}|\$\((\w+)\)')
+
+
+def global_lib_table():
+    """File name of the sym-lib-table of the user, where KiCad 6 keeps it"""
+    config = os.environ.get('KICAD_CONFIG_HOME')
+    if not config:
+        if sys.platform == 'win32':
+            base = os.environ.get('APPDATA', '')
+        elif sys.platform == 'darwin':
+            base = os.path.expanduser('~/Library/Preferences')
+        else:
+            base = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+        config = os.path.join(base, 'kicad', '6.0')
+    return os.path.join(config, 'sym-lib-table')
+
+
+def read_lib_table(filename, variables=None):
+    """Return (nickname, file name) for the enabled libraries of a
+    sym-lib-table, in table order. ${NAME} in a file name is taken from
+    variables, else from the environment, and is left as it is if found
+    in neither. Relative file names are relative to the table.
+    """
+    variables = variables or {}
+
+    def expand(m):
+        name = m.group(1) or m.group(2)
+        value = variables.get(name, os.environ.get(name))
+        return m.group(0) if value is None else value
+
+    libs = []
+    with open(filename) as f:
+        for expr in sexpr.iter_children(f):
+            if type(expr) is not list or not expr or expr[0] != 'lib' or find(expr, 'disabled') is not None:
+                continue
+            name = find(expr, 'name')
+            uri = find(expr, 'uri')
+            if name is None or uri is None:
+                continue
+            path = _VAR_RE.sub(expand, uri[1])
+            if _VAR_RE.search(path) is None:
+                path = os.path.join(os.path.dirname(filename), path)
+            libs.append((name[1], path))
+    return libs
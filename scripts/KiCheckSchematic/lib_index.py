@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent index of symbol libraries, shared by all projects
+
+An SQLite file records for each library file its size and mtime, and
+those of its .dcm, and for each symbol its name, aliases, unit and pin
+count, .dcm fields and where it starts in the file. A library which is
+unchanged is then loaded from the index without opening it: its symbols
+are lazy (see render_lib.LazySymbol) and only parsed from the library
+file if more than the above is used, e.g. to write a netlist.
+
+An entry is replaced as soon as its library is seen with another size or
+mtime.
+
+load_libraries() loads the libraries of a project, with or without an
+index.
+"""
+
+import copy
+import os
+import sqlite3
+
+import kicad_sym
+import render_lib
+
+# change when the tables or their meaning change
+INDEX_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE libraries (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    dcm_mtime REAL
+);
+CREATE TABLE symbols (
+    library INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    aliases TEXT NOT NULL,
+    units INTEGER NOT NULL,
+    pins INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    keywords TEXT NOT NULL,
+    datasheet TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER
+);
+CREATE INDEX symbols_library ON symbols (library, seq);
+"""
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class LibraryIndex(object):
+    """
+    The index in an SQLite file, see load()
+
+    hits and misses count the loads done through this object.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # other processes may use the index at the same time
+            db = sqlite3.connect(self.filename, timeout=60)
+            # names are str, also on Python 2
+            db.text_factory = str
+            if db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+                with db:
+                    db.execute("DROP TABLE IF EXISTS symbols")
+                    db.execute("DROP TABLE IF EXISTS libraries")
+                    for statement in _SCHEMA.split(';'):
+                        if statement.strip():
+                            db.execute(statement)
+                    db.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+            self._db = db
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _library(self, path, st, dcm_mtime):
+        """Id of the index entry of path, None if there is none or it is stale"""
+        row = self._connect().execute(
+            "SELECT id, size, mtime, dcm_mtime FROM libraries WHERE path = ?", (path,)).fetchone()
+        if row is not None and tuple(row[1:]) == (st.st_size, st.st_mtime, dcm_mtime):
+            return row[0]
+        return None
+
+    def load(self, libfile):
+        """Return the SymbolLibrary of libfile, from the index if unchanged"""
+        path = os.path.abspath(libfile)
+        st = os.stat(path)
+        dcm_mtime = _mtime(render_lib.change_ext(path, ".dcm"))
+
+        try:
+            library = self._library(path, st, dcm_mtime)
+        except sqlite3.Error:
+            # unusable index, do without
+            library = None
+
+        if library is not None:
+            self.hits += 1
+            return self._from_index(libfile, library)
+
+        self.misses += 1
+        lib = render_lib.SymbolLibrary()
+        lib.Load(libfile, lazy=True)
+        try:
+            self._store(lib, path, st, dcm_mtime)
+        except sqlite3.Error:
+            pass
+        return lib
+
+    def _from_index(self, libfile, library):
+        lib = render_lib.SymbolLibrary()
+        lib.filename = libfile
+        lib.name = render_lib.get_filename_without_extension(libfile)
+        kicad = libfile.endswith(".kicad_sym")
+
+        rows = self._connect().execute(
+            "SELECT name, aliases, units, pins, description, keywords, datasheet, start, end "
+            "FROM symbols WHERE library = ? ORDER BY seq", (library,))
+        for name, aliases, units, pins, description, keywords, datasheet, start, end in rows:
+            alias = aliases.split('\n') if aliases else []
+            if kicad:
+                symbol = kicad_sym.KicadSymbol(name, alias, (libfile, start, end))
+            else:
+                symbol = render_lib.LibSymbol(name, alias, (libfile, start))
+            symbol.n_units = units
+            symbol.known_pin_count = pins
+            symbol.description = description
+            symbol.keywords = keywords
+            symbol.datasheet = datasheet
+            lib.add_item(symbol)
+        return lib
+
+    def _store(self, lib, path, st, dcm_mtime):
+        records = []
+        for seq, item in enumerate(lib.items):
+            # where the symbol is, before parsing drops it
+            source = item._source
+            if isinstance(item, kicad_sym.KicadSymbol):
+                start, end = source[1], source[2]
+            else:
+                start, end = source[1], None
+            records.append((seq, item.name, '\n'.join(item.alias), item.n_units, item.pin_count(),
+                            item.description, item.keywords, item.datasheet, start, end))
+
+        db = self._connect()
+        with db:
+            db.execute("DELETE FROM symbols WHERE library IN (SELECT id FROM libraries WHERE path = ?)", (path,))
+            db.execute("DELETE FROM libraries WHERE path = ?", (path,))
+            library = db.execute(
+                "INSERT INTO libraries (path, size, mtime, dcm_mtime) VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, dcm_mtime)).lastrowid
+            db.executemany(
+                "INSERT INTO symbols (library, seq, name, aliases, units, pins, description, keywords, "
+                "datasheet, start, end) VALUES (%d, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % library, records)
+
+    def prune(self, seen=()):
+        """Remove the entries of libraries which no longer exist, return
+        their number. Those in seen, absolute paths just loaded, are known
+        to exist."""
+        seen = set(seen)
+        try:
+            db = self._connect()
+            gone = [row[0] for row in db.execute("SELECT path FROM libraries")
+                    if row[0] not in seen and not os.path.exists(row[0])]
+            with db:
+                for path in gone:
+                    db.execute("DELETE FROM symbols WHERE library IN (SELECT id FROM libraries WHERE path = ?)", (path,))
+                    db.execute("DELETE FROM libraries WHERE path = ?", (path,))
+        except sqlite3.Error:
+            # unusable index, left as it is
+            return 0
+        return len(gone)
+
+
+# libraries loaded by this process, by absolute path: (file state, library)
+_loaded = {}
+
+
+def _state(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime, _mtime(render_lib.change_ext(path, ".dcm"))
+
+
+def _copy_loaded(filename, state):
+    """A copy of the library this process loaded from filename, sharing
+    its symbols, None if it has not loaded it or the file changed since"""
+    loaded = _loaded.get(os.path.abspath(filename))
+    if loaded is None or loaded[0] != state:
+        return None
+    lib = copy.copy(loaded[1])
+    lib.filename = filename
+    return lib
+
+
+def load_library(filename, index=None):
+    """A lazily loaded SymbolLibrary, through index if there is one
+
+    A library is loaded once by a process as long as it does not change,
+    a later load returns a copy sharing the symbols, counted as a hit of
+    index.
+    """
+    path = os.path.abspath(filename)
+    state = _state(path)
+    lib = _copy_loaded(filename, state)
+    if lib is not None:
+        if index is not None:
+            index.hits += 1
+        return lib
+
+    if index is not None:
+        lib = index.load(filename)
+    else:
+        lib = render_lib.SymbolLibrary()
+        lib.Load(filename, lazy=True)
+    _loaded[path] = (state, lib)
+    return lib
+
+
+def load_libraries(filenames, index=None):
+    """Load libraries with load_library, in the order of filenames
+
+    This is done in this process: a lazy load only scans a library or
+    reads its entry in the index, which takes about as long as sending
+    its symbols back from a worker process would.
+    """
+    return [load_library(filename, index) for filename in filenames]
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""
+Net connectivity for legacy schematic sheets and sheet hierarchies
+
+Connection points (wire ends, junctions, labels, component pins and
+sheet pins) are hashed by position, and wires passing through each point
+are found with a fine grid spatial index of the wires, so no pairwise
+comparison of wires is needed. Points are merged into nets with
+union-find.
+
+Rules, following eeschema:
+  - wires connect their two ends
+  - every wire touching a connection point is connected to it, so a
+    wire ending on another wire connects, but crossing wires need a
+    junction
+  - labels with the same text are connected, local and hierarchical
+    labels within the sheet instance, global labels and invisible power
+    pins everywhere
+  - hierarchical labels of a sub-sheet connect to the pins of the same
+    name of its $Sheet
+  - bus wires, bus entries and notes lines are not followed
+"""
+
+import spatial
+
+
+class UnionFind(object):
+    """Disjoint sets of ints 0..n-1, with path halving and union by size"""
+
+    def __init__(self):
+        self.parent = []
+        self.size = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        self.size.append(1)
+        return len(self.parent) - 1
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+
+class Node(object):
+    """A component or sheet pin on a net"""
+    __slots__ = ('ref', 'pin', 'name', 'posx', 'posy')
+
+    def __init__(self, ref, pin, name, posx, posy):
+        self.ref = ref
+        self.pin = pin
+        self.name = name
+        self.posx = posx
+        self.posy = posy
+
+
+class Net(object):
+    def __init__(self, code, name):
+        self.code = code
+        self.name = name
+        self.nodes = []
+        self.labels = []
+
+    def __str__(self):
+        return "%s: %s" % (self.name, " ".join("%s-%s" % (n.ref, n.pin) for n in self.nodes))
+
+
+def symbol_name(comp):
+    """Library symbol name of a component, without any lib: prefix"""
+    return comp.labels['name'].rpartition(':')[2]
+
+
+def find_symbol(libs, name):
+    for lib in libs:
+        symbol = lib.find_name(name)
+        if symbol is not None:
+            return symbol
+    return None
+
+
+def component_pins(comp, symbol):
+    """Yield (pin, x, y) for the pins of symbol placed as comp"""
+    from render_lib import Pin
+
+    # the orientation matrix maps library coordinates (Y up) to the sheet
+    a, b, c, d = [int(v) for v in comp.rotation.split()[:4]]
+    unit = int(comp.unit['unit'] or 1)
+    convert = int(comp.unit['convert'] or 1)
+
+    for obj in symbol.objects:
+        if not isinstance(obj, Pin):
+            continue
+        if obj.unit not in (0, unit) or obj.convert not in (0, convert):
+            continue
+        x = comp.posx + a * obj.posx + b * obj.posy
+        y = comp.posy + c * obj.posx + d * obj.posy
+        yield obj, x, y
+
+
+def is_power_pin(pin):
+    """Invisible power input pins connect globally by pin name"""
+    return pin.elec_type == "W" and pin.pin_type.startswith("N")
+
+
+def instance_ref(comp, path):
+    """Reference of comp in the sheet instance path, from its AR lines,
+    else from its L line"""
+    wanted = 'Path="%s%s"' % (path, comp.unit.get('time_stamp', ''))
+    for reference in comp.references:
+        if reference['path'] == wanted:
+            return reference['ref'].partition('=')[2].strip('"')
+    return comp.labels['ref']
+
+
+class Netlist(object):
+    """
+    Nets of a schematic sheet, or of a whole sheet hierarchy
+
+    sheets is a sch.Schematic or a hierarchy.Hierarchy. In a hierarchy
+    every sheet instance is included: components get the reference of
+    their instance from the AR lines, hierarchical labels connect to the
+    pins of their $Sheet in the parent sheet, and global labels and power
+    pins connect across sheets. Local and hierarchical label names are
+    prefixed with the sheet names, e.g. /VIN in the root sheet and
+    /Sub/VIN in a sub-sheet. A net is named by a global label, else by a
+    local label before a hierarchical one, nearest to the root sheet
+    first. Pins of a $Sheet whose file was not loaded are nodes of their
+    own.
+
+    libs is a list of render_lib.SymbolLibrary used to find component
+    pins, components whose symbol is not found are listed once each in
+    unresolved, as (sheet file, component).
+    """
+
+    # grid of the wire index, about the length of short wires
+    cell_size = 100
+
+    def __init__(self, sheets, libs=()):
+        if hasattr(sheets, 'root'):
+            self.root = sheets.root
+        else:
+            import hierarchy
+            self.root = hierarchy.SheetInstance("", sheets.filename, "/", sheets)
+        self.schema = self.root.schema
+        self.nets = []
+        # (ref, component) for each component instance
+        self.components = []
+        self.unresolved = []
+
+        self._uf = UnionFind()
+        # sheet instance path -> {(x, y): node}
+        self._points = {}
+        self._named = {}
+
+        self._build(libs)
+
+    def _node(self, path, x, y):
+        points = self._points[path]
+        key = (x, y)
+        node = points.get(key)
+        if node is None:
+            node = points[key] = self._uf.add()
+        return node
+
+    def _name(self, scope, path, name, node):
+        key = (scope, path, name)
+        other = self._named.get(key)
+        if other is None:
+            self._named[key] = node
+        else:
+            self._uf.union(node, other)
+
+    def _build(self, libs):
+        # (node, Node) for every component and sheet pin, (node, scope, depth, net name) for every label
+        pins = []
+        labels = []
+        symbols = {}
+        wire_indexes = {}
+        unresolved = set()
+        for instance, prefix, depth in self._instances(self.root, "", 0):
+            self._add_sheet(instance, prefix, depth, libs, symbols, wire_indexes, unresolved, pins, labels)
+        self._collect(pins, labels)
+
+    def _instances(self, instance, prefix, depth):
+        """Yield (instance, label name prefix, depth) for instance and those below it"""
+        yield instance, prefix, depth
+        for child in instance.children:
+            for found in self._instances(child, prefix + "/" + child.name, depth + 1):
+                yield found
+
+    def _add_sheet(self, instance, prefix, depth, libs, symbols, wire_indexes, unresolved, pins, labels):
+        schema = instance.schema
+        path = instance.path
+        uf = self._uf
+        points = self._points[path] = {}
+
+        wires = [w for w in schema.wires if w.type1 == "Wire"]
+        for w in wires:
+            uf.union(self._node(path, w.startx, w.starty), self._node(path, w.endx, w.endy))
+
+        for item in schema.conns:
+            self._node(path, item.posx, item.posy)
+
+        for item in schema.texts:
+            if item.type == "Label":
+                scope, scope_path, name = "local", path, prefix + "/" + item.data
+            elif item.type == "HLabel":
+                scope, scope_path, name = "hier", path, prefix + "/" + item.data
+            elif item.type == "GLabel":
+                scope, scope_path, name = "global", "", item.data
+            else:
+                continue
+            node = self._node(path, item.posx, item.posy)
+            self._name(scope, scope_path, item.data, node)
+            labels.append((node, scope, depth, name))
+
+        for comp in schema.components:
+            name = symbol_name(comp)
+            if name not in symbols:
+                symbols[name] = find_symbol(libs, name)
+            symbol = symbols[name]
+            if symbol is None:
+                if id(comp) not in unresolved:
+                    unresolved.add(id(comp))
+                    self.unresolved.append((schema.filename, comp))
+                continue
+            ref = instance_ref(comp, path)
+            self.components.append((ref, comp))
+            for pin, x, y in component_pins(comp, symbol):
+                node = self._node(path, x, y)
+                pins.append((node, Node(ref, pin.num, pin.name, x, y)))
+                if is_power_pin(pin):
+                    self._name("global", "", pin.name, node)
+
+        children = dict((id(child.sheet), child) for child in instance.children)
+        for sheet in schema.sheets:
+            child = children.get(id(sheet))
+            for f in sheet.fields:
+                if not f['id'] in ["F0", "F1"]:
+                    x, y = int(f['posx']), int(f['posy'])
+                    pin_name = f['value'].strip('"')
+                    node = self._node(path, x, y)
+                    if child is not None:
+                        self._name("hier", child.path, pin_name, node)
+                    else:
+                        pins.append((node, Node(sheet.fields[0]['value'].strip('"'), pin_name, "", x, y)))
+
+        # wires passing through a connection point join it
+        if wires:
+            index = wire_indexes.get(id(schema))
+            if index is None:
+                index = wire_indexes[id(schema)] = spatial.SpatialIndex(wires, self.cell_size)
+            for (x, y), node in points.items():
+                for item in index.at(x, y):
+                    uf.union(node, points[(item.startx, item.starty)])
+
+    def _collect(self, pins, labels):
+        uf = self._uf
+        by_root = {}
+
+        def net_for(node):
+            root = uf.find(node)
+            net = by_root.get(root)
+            if net is None:
+                net = by_root[root] = Net(0, None)
+            return net
+
+        for node, pin in pins:
+            net_for(node).nodes.append(pin)
+
+        for node, scope, depth, name in labels:
+            net_for(node).labels.append((scope, depth, name))
+
+        # only nets with pins are of interest
+        nets = [net for net in by_root.values() if net.nodes]
+        for net in nets:
+            net.nodes.sort(key=lambda n: (n.ref, n.pin))
+            net.name = self._net_name(net)
+        nets.sort(key=lambda net: net.name)
+
+        for code, net in enumerate(nets):
+            net.code = code + 1
+        self.nets = nets
+
+    # rank of a label scope for naming a net, lowest first
+    _SCOPE_RANK = {"global": 0, "local": 1, "hier": 2}
+
+    def _net_name(self, net):
+        # like eeschema, a global label names the net, else a local label
+        # before a hierarchical one, then the label nearest to the root sheet
+        if net.labels:
+            rank = self._SCOPE_RANK
+            return min((rank[scope], depth, name) for scope, depth, name in net.labels)[2]
+
+        for node in net.nodes:
+            if node.name and node.ref.startswith("#"):
+                # power symbol
+                return node.name
+
+        first = net.nodes[0]
+        return "Net-(%s-Pad%s)" % (first.ref, first.pin)
+
+    def write(self, filename):
+        """Write the nets in the KiCad (export (version D)) netlist format,
+        power symbols are left out like eeschema does
+        """
+        def quote(s):
+            return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+        with open(filename, "w") as f:
+            f.write('(export (version D)\n')
+            f.write('  (components\n')
+            for ref, comp in self.components:
+                if ref.startswith("#"):
+                    continue
+                value = comp.fields[1]['ref'].strip('"') if len(comp.fields) > 1 else ""
+                f.write('    (comp (ref %s) (value %s) (libsource (part %s)))\n' % (
+                    quote(ref), quote(value), quote(comp.labels['name'])))
+            f.write('  )\n')
+            f.write('  (nets\n')
+            for net in self.nets:
+                nodes = [node for node in net.nodes if not node.ref.startswith("#")]
+                f.write('    (net (code %d) (name %s)\n' % (net.code, quote(net.name)))
+                for node in nodes:
+                    f.write('      (node (ref %s) (pin %s))\n' % (quote(node.ref), quote(node.pin)))
+                f.write('    )\n')
+            f.write('  )\n')
+            f.write(')\n')
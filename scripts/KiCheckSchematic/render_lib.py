@@ -2,12 +2,15 @@
 
 """This code is originally from schlib-render.py"""
 
+import locale
 import os
-import shlex
+import re
 import sys
 
 from decimal import Decimal
 
+from tokenizer import split_lib_line
+
 
 # kicad lib utils
 common = os.path.abspath(os.path.join(sys.path[0], 'common'))
@@ -69,19 +72,7 @@ class LineParser(object):
             self.raw = self.f.readline()
         self.stripped = self.raw.strip()
         try:
-            #self.parts = shlex.split(self.stripped)
-            #tokens = self.stripped.split()
-            #self.parts = []
-            #for tok in tokens:
-            #    if tok.startswith('"') and tok.endswith('"'):
-            #        tok = tok[1:-1]
-            #    self.parts.append (tok)
-            s = shlex.shlex(self.stripped)
-            s.whitespace_split = True
-            s.commenters = ''
-            s.quotes = '"'
-            self.parts = list(s)
-
+            self.parts = split_lib_line(self.stripped)
         except ValueError:
             self.parts = []
     def push(self):
@@ -101,7 +92,7 @@ class LineParser(object):
     
 class KicadObject(object):
     def parse_line_into(self, parser, *values):
-        """Parse a shlex-split line into this object's instance variables.
+        """Parse a split line into this object's instance variables.
         @param parser - a LineParser positioned at the current line
         @param values - a list of tuples (name, converter); if name is None the
             field will be ignored.
@@ -154,7 +145,7 @@ class SchSymbol(KicadObject):
             if not parser.raw or parser.raw.startswith("#"):
                 continue
             if not parser.parts:
-                raise ValueError("shlex could not parse line %d" % parser.lineno)
+                raise ValueError("could not parse line %d" % parser.lineno)
 
             if state == "root":
                 if parser.parts[0] == "EESchema-LIBRARY":
@@ -229,6 +220,10 @@ class SchSymbol(KicadObject):
         lines.extend(str(i) for i in self.objects)
         return '\n'.join(lines)
 
+    def pin_count(self):
+        """Number of distinct pin numbers"""
+        return len(set(obj.num for obj in self.objects if isinstance(obj, Pin)))
+
     def filter_unit(self, unit):
         self.objects = [i for i in self.objects if (i.unit == unit or i.unit == 0)]
 
@@ -258,6 +253,77 @@ class SchSymbol(KicadObject):
 
         self.objects.sort(key=sortkey)
 
+class LazySymbol(SchSymbol):
+    """
+    A symbol of which only the name and aliases are known until another
+    attribute is first used, or parse() is called. Then load_source()
+    fills it from source, whatever the subclass keeps there.
+
+    A description, keywords or datasheet set before that, e.g. from a
+    .dcm file, is kept. n_units and known_pin_count may be set as well,
+    by whoever knows them, so that they are answered without parsing.
+    """
+
+    def __init__(self, name, alias, source):
+        self.symbol_name = name
+        self.alias = alias
+        self.description = ""
+        self.keywords = ""
+        self.datasheet = ""
+        self.valid = True
+        self.known_pin_count = None
+        self._source = source
+
+    @property
+    def name(self):
+        return self.symbol_name
+
+    def is_parsed(self):
+        return self._source is None
+
+    def pin_count(self):
+        if self._source is not None and self.known_pin_count is not None:
+            return self.known_pin_count
+        return SchSymbol.pin_count(self)
+
+    def __getattr__(self, name):
+        # only reached for attributes not set yet, i.e. before parsing
+        if name.startswith('_') or self.__dict__.get('_source') is None:
+            raise AttributeError(name)
+        self.parse()
+        return getattr(self, name)
+
+    def parse(self):
+        if self._source is None:
+            return
+        source = self._source
+        self._source = None
+
+        kept = [(attr, getattr(self, attr)) for attr in ('description', 'keywords', 'datasheet')]
+        alias = self.alias
+        SchSymbol.__init__(self)
+        self.load_source(source)
+        self.alias = alias
+        for attr, value in kept:
+            if value:
+                setattr(self, attr, value)
+        self.valid = True
+
+    def load_source(self, source):
+        raise NotImplementedError
+
+
+class LibSymbol(LazySymbol):
+    """A symbol of a .lib file, source is (file name, offset of DEF)"""
+
+    def load_source(self, source):
+        filename, offset = source
+        with open(filename) as f:
+            # a byte offset of a line start, which text files accept as well
+            f.seek(offset)
+            self.parse_kicad(LineParser(f))
+
+
 class Field(KicadObject):
     def __init__(self, parent, stack=None):
         self.parent = parent
@@ -527,21 +593,116 @@ def get_filename_without_extension (filename):
     return basename
 
 
+# the lines of a .lib file a lazy load looks at, never the first line of the
+# file: matching from a newline is much faster than from ^ with re.M
+_LIB_INDEX_RE = re.compile(br'\n[ \t]*(DEF|F1|ALIAS|ENDDEF)\b([^\n]*)')
+
+# the pin number of a pin line, e.g. X VCC 1 0 200 100 D 50 50 1 1 W
+_LIB_PIN_RE = re.compile(br'\n[ \t]*X[ \t]+[^ \t\r\n]+[ \t]+([^ \t\r\n]+)')
+
+# a pin line with a quoted name or number, which only split_lib_line splits
+# as the parser does
+_LIB_QUOTED_PIN_RE = re.compile(br'\n[ \t]*X[ \t]+(?:[^ \t\r\n]+[ \t]+)?"')
+
+
+def _decode(data):
+    if isinstance(data, str):
+        # python 2
+        return data
+    return data.decode(locale.getpreferredencoding(False))
+
+
+def _pin_count(data, start, end, quoted):
+    """Number of distinct pin numbers of the symbol in data[start:end]"""
+    if not quoted:
+        return len(set(_LIB_PIN_RE.findall(data, start, end)))
+    pins = set()
+    for line in data[start:end].splitlines():
+        parts = split_lib_line(_decode(line).strip())
+        if len(parts) > 2 and parts[0] == 'X':
+            pins.add(parts[2])
+    return len(pins)
+
+
+def scan_library(filename):
+    """Return (name, aliases, offset of DEF, n_units, pin count) for the
+    symbols of a .lib file, looking only at the DEF, F1, ALIAS, ENDDEF and
+    pin lines. n_units is None if the DEF line has no number of units.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    quoted = _LIB_QUOTED_PIN_RE.search(data) is not None
+    symbols = []
+    offset = None
+    for m in _LIB_INDEX_RE.finditer(data):
+        keyword = m.group(1)
+        if keyword == b'DEF':
+            offset = m.start() + 1
+            name = None
+            alias = []
+            line = m.group(2)
+            parts = line.split() if b'"' not in line else split_lib_line(_decode(line).strip())
+            n_units = int(parts[6]) if len(parts) > 6 and parts[6].isdigit() else None
+        elif offset is None:
+            continue
+        elif keyword == b'F1':
+            parts = split_lib_line(_decode(m.group(2)).strip())
+            if parts:
+                name = parts[0].strip('"')
+        elif keyword == b'ALIAS':
+            alias += split_lib_line(_decode(m.group(2)).strip())
+        elif name is not None:
+            symbols.append((name, alias, offset, n_units, _pin_count(data, offset, m.start(), quoted)))
+            offset = None
+    return symbols
+
+
 class SymbolLibrary:
     def __init__(self):
         self.items = []
+        self.reindex()
 
-    def get_item(self, name):
+    def reindex(self):
+        """Rebuild the name and alias indexes from self.items
+
+        names maps symbol names and aliases maps symbol and alias names to
+        items, the first item wins as in a search of items in order. Items
+        should be added with add_item, lookups reindex if items has been
+        changed otherwise.
+        """
+        self.names = {}
+        self.aliases = {}
+        self.indexed = 0
         for item in self.items:
-            if item.name == name:
-                return item
-        return None
+            self._index_item(item)
+
+    def _index_item(self, item):
+        self.names.setdefault(item.name, item)
+        self.aliases.setdefault(item.name, item)
+        for a in item.alias:
+            self.aliases.setdefault(a, item)
+        self.indexed += 1
+
+    def add_item(self, item):
+        self.items.append(item)
+        self._index_item(item)
+
+    def get_item(self, name):
+        if self.indexed != len(self.items):
+            self.reindex()
+        return self.names.get(name)
 
     def find_name (self, name):
-        for item in self.items:
-            if item.name == name or name in item.alias:
-                return item
-        return None
+        if self.indexed != len(self.items):
+            self.reindex()
+        return self.aliases.get(name)
+
+    def all_names(self):
+        """Names of all symbols and aliases"""
+        if self.indexed != len(self.items):
+            self.reindex()
+        return list(self.aliases)
 
     # todo : dcm fields per alias
     def load_dcm(self, f):
@@ -560,18 +721,37 @@ class SymbolLibrary:
             elif line.startswith("$ENDCMP"):
                 item = None
 
-    def Load (self, libfile):
+    def Load (self, libfile, lazy=False):
+        """Load a .lib or .kicad_sym file. With lazy, only the names and
+        aliases are read, each symbol is parsed when first used.
+        """
 
         self.filename = libfile
         self.name = get_filename_without_extension (libfile)
         self.items = []
-        with open(libfile) as f:
-            parser = LineParser(f)
+        self.reindex()
+
+        if libfile.endswith(".kicad_sym"):
+            import kicad_sym
+            for obj in kicad_sym.load_symbols(libfile, lazy):
+                self.add_item(obj)
+            return self.items
+
+        if lazy:
+            for name, alias, offset, n_units, pins in scan_library(libfile):
+                symbol = LibSymbol(name, alias, (libfile, offset))
+                if n_units is not None:
+                    symbol.n_units = n_units
+                symbol.known_pin_count = pins
+                self.add_item(symbol)
+        else:
+            with open(libfile) as f:
+                parser = LineParser(f)
 
-            while not parser.eof():
-                obj = SchSymbol(parser)
-                if obj.valid:
-                    self.items.append (obj)
+                while not parser.eof():
+                    obj = SchSymbol(parser)
+                    if obj.valid:
+                        self.add_item (obj)
 
         dcmfile = change_ext (libfile, ".dcm")
 
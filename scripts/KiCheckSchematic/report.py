@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Findings of a check, written as JSON Lines or JUnit XML
+
+A Finding records one warning or error: its severity, the project and
+sheet file it was found in, the kind of item (e.g. "comp", "wire",
+"library"), the coordinates of the item in mils where there are any, and
+the message. Project wide findings have no sheet.
+
+The writers take a list of results, objects with
+    project     the project file
+    sheets      the sheet files checked, in order
+    findings    the Findings
+and write the whole report with a few large writes.
+"""
+
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+FORMATS = ('jsonl', 'junit')
+
+# lines written at once
+_CHUNK = 1000
+
+
+class Finding(object):
+    def __init__(self, severity, project, sheet, kind, x, y, message):
+        self.severity = severity
+        self.project = project
+        self.sheet = sheet
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.message = message
+
+    def as_dict(self):
+        return {'severity': self.severity, 'project': self.project, 'sheet': self.sheet,
+                'kind': self.kind, 'x': self.x, 'y': self.y, 'message': self.message}
+
+    def __str__(self):
+        return "%s: %s" % (self.severity, self.message)
+
+
+def _bytes(text):
+    if isinstance(text, bytes):
+        # python 2 str
+        return text
+    return text.encode('utf-8')
+
+
+def format_for(filename):
+    """The report format implied by a file name"""
+    return 'junit' if filename.lower().endswith('.xml') else 'jsonl'
+
+
+def write_json_lines(all_results, f):
+    """One JSON object per finding, f is a binary file"""
+    encode = json.JSONEncoder(sort_keys=True).encode
+    lines = []
+    for results in all_results:
+        for finding in results.findings:
+            lines.append(encode(finding.as_dict()))
+            if len(lines) == _CHUNK:
+                f.write(_bytes('\n'.join(lines) + '\n'))
+                lines = []
+    if lines:
+        f.write(_bytes('\n'.join(lines) + '\n'))
+
+
+def _testcase(project, name, findings):
+    errors = [finding for finding in findings if finding.severity == 'error']
+    warnings = [finding for finding in findings if finding.severity != 'error']
+    out = ['    <testcase classname=%s name=%s>' % (quoteattr(project), quoteattr(name))]
+    if errors:
+        out.append('      <failure type="error" message=%s>%s</failure>' % (
+            quoteattr("%d errors" % len(errors)), escape('\n'.join(str(e) for e in errors))))
+    if warnings:
+        out.append('      <system-out>%s</system-out>' % escape('\n'.join(str(w) for w in warnings)))
+    out.append('    </testcase>')
+    return out, 1 if errors else 0
+
+
+def write_junit(all_results, f):
+    """A test suite per project, a test case per sheet and one for the
+    project wide findings, failed if there are errors; f is a binary file
+    """
+    suites = []
+    total_tests = 0
+    total_failures = 0
+    for results in all_results:
+        by_sheet = {}
+        for finding in results.findings:
+            by_sheet.setdefault(finding.sheet, []).append(finding)
+        sheets = [None] + list(results.sheets)
+        sheets += sorted(sheet for sheet in by_sheet if sheet not in sheets)
+
+        cases = []
+        failures = 0
+        for sheet in sheets:
+            lines, failed = _testcase(results.project, sheet or results.project, by_sheet.get(sheet, []))
+            cases += lines
+            failures += failed
+        suites.append('  <testsuite name=%s tests="%d" failures="%d" errors="0">' % (
+            quoteattr(results.project), len(sheets), failures))
+        suites += cases
+        suites.append('  </testsuite>')
+        total_tests += len(sheets)
+        total_failures += failures
+
+    f.write(_bytes('<?xml version="1.0" encoding="UTF-8"?>\n'))
+    f.write(_bytes('<testsuites tests="%d" failures="%d">\n' % (total_tests, total_failures)))
+    for start in range(0, len(suites), _CHUNK):
+        f.write(_bytes('\n'.join(suites[start:start + _CHUNK]) + '\n'))
+    f.write(_bytes('</testsuites>\n'))
+
+
+def write(all_results, filename, report_format=None):
+    """Write the findings of all_results to filename, in report_format or
+    else the format implied by the file name"""
+    writer = write_junit if (report_format or format_for(filename)) == 'junit' else write_json_lines
+    with open(filename, 'wb') as f:
+        writer(all_results, f)
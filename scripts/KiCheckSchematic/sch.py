@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 
 #
-# This code was taken without change from https://github.com/KiCad/kicad-library-utils/tree/master/sch.
+# This code is derived from https://github.com/KiCad/kicad-library-utils/tree/master/sch
+# and has been modified: lazy parsing, int coordinates, a dispatch table
+# loader, component indexes and saving of unmodified items verbatim.
 # It's covered by GPL3.
 #
 
+import filecmp
+import os
+import shutil
 import sys
-import re
+import tempfile
+from operator import attrgetter
+
+from file_util import new_file_mode, replace_file
+from tokenizer import split_line, make_dict
 
 class Description(object):
     """
@@ -16,17 +25,149 @@ class Description(object):
     def __init__(self, data):
         self.raw_data = data
 
+class _Unset(object):
+    """Marks an attribute not set"""
+
+_SLOT_INFO = {}
+
+def _slot_info(cls):
+    """Return the slot names of cls and a getter of their values as a tuple"""
+    info = _SLOT_INFO.get(cls)
+    if info is None:
+        names = tuple(name for c in cls.__mro__ for name in getattr(c, '__slots__', ()))
+        info = _SLOT_INFO[cls] = (names, attrgetter(*names))
+    return info
+
+# sets a slot without marking the item modified, used when parsing
+_set = object.__setattr__
+
+def _restore(cls, values):
+    item = object.__new__(cls)
+    for name, value in zip(_slot_info(cls)[0], values):
+        if value is not _Unset:
+            _set(item, name, value)
+    return item
+
 class SchematicItem (object):
     """
     Base class for schematic objects
+
+    Coordinates are held as ints, and only formatted again by get_text.
+
+    Items loaded from a file remember their source lines, which are saved
+    unchanged until the item is modified. Setting an attribute marks the
+    item modified. Code changing a field, label or other dict or list of
+    an item in place must call set_modified() before changing it, or the
+    change is not saved.
     """
+    # _span is (lines, start, end), unset or None for a new or modified item
+    __slots__ = ('_span',)
+
     def __init__(self, data):
         pass
 
+    def __setattr__(self, name, value):
+        _set(self, name, value)
+        if name[0] != '_':
+            _set(self, '_span', None)
+
+    def set_modified(self):
+        self._span = None
+
+    def is_modified(self):
+        return getattr(self, '_span', None) is None
+
+    def source_lines(self):
+        """Return the source lines, None if the item is new or modified"""
+        span = getattr(self, '_span', None)
+        if span is None:
+            return None
+        lines, start, end = span
+        return lines[start:end]
+
+    def __reduce__(self):
+        # the slot values in a tuple, restored by _restore without calling
+        # __init__
+        names, get_values = _slot_info(type(self))
+        try:
+            values = get_values(self)
+        except AttributeError:
+            values = self._slot_values(names)
+        return _restore, (type(self), values)
+
+    def _slot_values(self, names):
+        """Slot values, _Unset for those not set, without parsing a LazyItem"""
+        values = []
+        for name in names:
+            try:
+                values.append(object.__getattribute__(self, name))
+            except AttributeError:
+                values.append(_Unset)
+        return tuple(values)
+
     def get_text (self):
         return []
 
-class Component(SchematicItem):
+class LazyItem(SchematicItem):
+    """
+    Base class for block items which can defer parsing of their lines until
+    one of their attributes is first read or set, or set_modified() is
+    called. Until then get_text returns the source lines unchanged.
+    """
+    __slots__ = ('_source',)
+
+    def __init__(self, data):
+        self._source = None
+        self._parse(data)
+
+    @classmethod
+    def lazy(cls, lines, start, end):
+        """Create an item for the block lines[start:end], parsed on first use"""
+        item = cls.__new__(cls)
+        _set(item, '_source', (lines, start, end))
+        _set(item, '_span', (lines, start, end))
+        return item
+
+    def _parse(self, data):
+        pass
+
+    def __setattr__(self, name, value):
+        if name[0] != '_':
+            # parse first, so that the value is not reset by _parse
+            if self._source is not None:
+                self._load_source()
+            _set(self, '_span', None)
+        _set(self, name, value)
+
+    def _load_source(self):
+        lines, start, end = self._source
+        span = self._span
+        self._source = self._span = None
+        self._parse(lines[start:end])
+        self._span = span
+
+    def is_parsed(self):
+        return self._source is None
+
+    def set_modified(self):
+        if self._source is not None:
+            self._load_source()
+        self._span = None
+
+    def __reduce__(self):
+        if self._source is not None:
+            # pickle it unparsed
+            return _restore, (type(self), self._slot_values(_slot_info(type(self))[0]))
+        return SchematicItem.__reduce__(self)
+
+    def __getattr__(self, name):
+        # only reached when an attribute is not set, i.e. the block is not parsed yet
+        if name.startswith('_') or self._source is None:
+            raise AttributeError(name)
+        self._load_source()
+        return getattr(self, name)
+
+class Component(LazyItem):
     """
     Component
     """
@@ -37,52 +178,59 @@ class Component(SchematicItem):
     _F_KEYS = ['id', 'ref', 'orient', 'posx', 'posy', 'size', 'attributes', 'hjust', 'props', 'name']
 
     _KEYS = {'L':_L_KEYS, 'U':_U_KEYS, 'P':_P_KEYS, 'AR':_AR_KEYS, 'F':_F_KEYS}
-    def __init__(self, data):
-        self.labels = {}
-        self.unit = {}
+
+    __slots__ = ('labels', 'unit', 'references', 'fields', 'posx', 'posy', 'rotation')
+
+    def _parse(self, data):
+        _set(self, 'labels', {})
+        _set(self, 'unit', {})
         #self.position = {}
-        self.references = []
-        self.fields = []
+        _set(self, 'references', [])
+        _set(self, 'fields', [])
         #self.old_stuff = []
         
         for line in data:
-            if line[0] == '\t':
+            first = line[0]
+            if first == '\t':
                 #self.old_stuff.append(line)
-                self.rotation = line.strip()
+                _set(self, 'rotation', line.strip())
+                continue
+            if first == '$':
+                # $Comp, $EndComp
                 continue
 
-            line = line.replace('\n', '')
-
-            # Extract all the non-quoted and quoted text pieces, accounting for escaped quotes. 
-            pieces = re.findall(r'[^\s"]+|(?<!\\)".*?(?<!\\)"', line)
-
-            line = []
-            for i in range(len(pieces)):
-                # Merge a piece ending with equals sign with the next piece.
-                if pieces[i] and pieces[i][-1] == '=':
-                    pieces[i] = pieces[i] + pieces[i+1]
-                    pieces[i+1] = ''  # Empty the next piece because it was merged with this one.
-                # Append any non-empty piece.
-                if pieces[i]:
-                    line.append(pieces[i])
-
-            # select the keys list and default values array
-            if line[0] in self._KEYS:
-                key_list = self._KEYS[line[0]]
-                values = line[1:] + ['' for n in range(len(key_list) - len(line[1:]))]
-
-            if line[0] == 'L':
-                self.labels = dict(zip(key_list,values))
-            elif line[0] == 'U':
-                self.unit = dict(zip(key_list,values))
-            elif line[0] == 'P':
-                #self.position = dict(zip(key_list,values))
-                self.posx = values[0]
-                self.posy = values[1]
-            elif line[0] == 'AR':
-                self.references.append(dict(zip(key_list,values)))
-            elif line[0] == 'F':
-                self.fields.append(dict(zip(key_list,values)))
+            line = split_line(line)
+
+            key = line[0]
+            if key == 'L':
+                _set(self, 'labels', make_dict(self._L_KEYS, line[1:]))
+            elif key == 'U':
+                _set(self, 'unit', make_dict(self._U_KEYS, line[1:]))
+            elif key == 'P':
+                #self.position = make_dict(self._P_KEYS, line[1:])
+                _set(self, 'posx', int(line[1]))
+                _set(self, 'posy', int(line[2]))
+            elif key == 'AR':
+                self.references.append(make_dict(self._AR_KEYS, line[1:]))
+            elif key == 'F':
+                self.fields.append(make_dict(self._F_KEYS, line[1:]))
+
+    def index_keys(self):
+        """Return (ref, name, time_stamp) from the L and U lines, read from
+        the source lines without parsing the block if it is not parsed yet
+        """
+        if self._source is None:
+            labels = self.labels
+            unit = self.unit
+        else:
+            labels = unit = {}
+            for line in self.source_lines():
+                if line.startswith('L '):
+                    labels = make_dict(self._L_KEYS, split_line(line)[1:])
+                elif line.startswith('U '):
+                    unit = make_dict(self._U_KEYS, split_line(line)[1:])
+                    break
+        return labels.get('ref', ''), labels.get('name', ''), unit.get('time_stamp', '')
 
     # TODO: error checking
     # * check if field_data is a dictionary
@@ -99,9 +247,13 @@ class Component(SchematicItem):
         field['id'] = str(len(self.fields))
 
         self.fields.append(field)
+        self.set_modified()
         return field
 
     def get_text (self):
+        if self._source is not None:
+            return self.source_lines()
+
         to_write = []
         to_write += ['$Comp\n']
         if self.labels:
@@ -116,7 +268,7 @@ class Component(SchematicItem):
                 line += self.unit[key] + ' '
             to_write += [line.rstrip() + '\n']
 
-        to_write += ["P %s %s\n" % (self.posx, self.posy)]
+        to_write += ["P %d %d\n" % (self.posx, self.posy)]
 
         for reference in self.references:
             if self.references:
@@ -131,13 +283,13 @@ class Component(SchematicItem):
                 line += field[key] + ' '
             to_write += [line.rstrip() + '\n']
 
-        to_write += ["\t%s %s %s\n" % (self.unit['unit'], self.posx, self.posy)]
+        to_write += ["\t%s %d %d\n" % (self.unit['unit'], self.posx, self.posy)]
         to_write += ["\t%s\n" % (self.rotation)]
 
         to_write += ['$EndComp\n']
         return to_write
 
-class Sheet(SchematicItem):
+class Sheet(LazyItem):
     """
     Container for hierarchical Sheet object
     """
@@ -147,54 +299,41 @@ class Sheet(SchematicItem):
 
     _KEYS = {'S':_S_KEYS, 'U':_U_KEYS, 'F':_F_KEYS}
 
-    def __init__(self, data):
+    __slots__ = ('unique_id', 'fields', 'posx', 'posy', 'width', 'height')
+
+    def _parse(self, data):
         #self.shape = {}
-        self.unique_id = ""
-        self.fields = []
+        _set(self, 'unique_id', "")
+        _set(self, 'fields', [])
         # F0 is sheet name
         # F1 is sheet file name
         # F2.. are hierarchical pins
         for line in data:
 
-            line = line.replace('\n', '')
-
-            # Extract all the non-quoted and quoted text pieces, accounting for escaped quotes. 
-            pieces = re.findall(r'[^\s"]+|(?<!\\)".*?(?<!\\)"', line)
-
-            line = []
-            for i in range(len(pieces)):
-                # Merge a piece ending with equals sign with the next piece.
-                if pieces[i] and pieces[i][-1] == '=':
-                    pieces[i] = pieces[i] + pieces[i+1]
-                    pieces[i+1] = ''  # Empty the next piece because it was merged with this one.
-                # Append any non-empty piece.
-                if pieces[i]:
-                    line.append(pieces[i])
-
-            # select the keys list and default values array
-            if line[0] in self._KEYS:
-                key_list = self._KEYS[line[0]]
-                values = line[1:] + ['' for n in range(len(key_list) - len(line[1:]))]
-
-            if line[0] == 'S':
-                #self.shape = dict(zip(key_list,values))
-                self.posx = values[0]
-                self.posy = values[1]
-                self.width = values[2]
-                self.height = values[3]
-
-            elif line[0] == 'U':
-                self.unique_id = values[0]
-
-            elif line[0][0] == 'F':
-                key_list = self._F_KEYS
-                values = line + ['' for n in range(len(key_list) - len(line))]
-                self.fields.append(dict(zip(key_list,values)))
+            line = split_line(line)
+
+            key = line[0]
+            if key == 'S':
+                #self.shape = make_dict(self._S_KEYS, line[1:])
+                posx, posy, width, height = [int(v) for v in line[1:5]]
+                _set(self, 'posx', posx)
+                _set(self, 'posy', posy)
+                _set(self, 'width', width)
+                _set(self, 'height', height)
+
+            elif key == 'U':
+                _set(self, 'unique_id', line[1] if len(line) > 1 else '')
+
+            elif key[0] == 'F':
+                self.fields.append(make_dict(self._F_KEYS, line))
 
     def get_text (self):
+        if self._source is not None:
+            return self.source_lines()
+
         to_write = []
         to_write += ['$Sheet\n']
-        line = "S %s %s %s %s\n" % (self.posx, self.posy, self.width, self.height)
+        line = "S %d %d %d %d\n" % (self.posx, self.posy, self.width, self.height)
         to_write += [line]
 
         line = 'U '
@@ -215,21 +354,23 @@ class Bitmap(SchematicItem):
     A container for bitmaps
     TODO: Need to be done, currently just stores the raw data read from file
     """
+    __slots__ = ('posx', 'posy', 'scale', 'bitmap_data')
+
     def __init__(self, data):
 
         tokens = data[1].split()
-        self.posx = tokens[1]
-        self.posy = tokens[2]
+        _set(self, 'posx', int(tokens[1]))
+        _set(self, 'posy', int(tokens[2]))
 
         tokens = data[2].split()
-        self.scale = tokens[1]
+        _set(self, 'scale', tokens[1])
 
         # Data ... EndData
-        self.bitmap_data = data [3:-1]
+        _set(self, 'bitmap_data', data [3:-1])
 
     def get_text (self):
         to_write = ["$Bitmap\n"]
-        to_write += ["Pos %s %s\n" % (self.posx, self.posy)]
+        to_write += ["Pos %d %d\n" % (self.posx, self.posy)]
         to_write += ["Scale %s\n" % (self.scale)]
         to_write += self.bitmap_data
         to_write += ["$EndBitmap\n"]
@@ -242,23 +383,23 @@ class Wire(SchematicItem):
         Wire Bus Line        - bus lines
         Wire Notes Line      - documentary lines
     """
-    def __init__(self, data):
-        self.raw_data = data
+    __slots__ = ('type1', 'type2', 'startx', 'starty', 'endx', 'endy')
 
+    def __init__(self, data):
         tokens = data[0].split()
-        self.type1 = tokens[1]
-        self.type2 = tokens[2]
+        _set(self, 'type1', tokens[1])
+        _set(self, 'type2', tokens[2])
 
-        tokens = data[1].split()
-        self.startx = tokens[0]
-        self.starty = tokens[1]
-        self.endx = tokens[2]
-        self.endy = tokens[3]
+        startx, starty, endx, endy = [int(v) for v in data[1].split()[:4]]
+        _set(self, 'startx', startx)
+        _set(self, 'starty', starty)
+        _set(self, 'endx', endx)
+        _set(self, 'endy', endy)
 
     def get_text (self):
         to_write = []
         to_write += ["Wire %s %s\n" % (self.type1, self.type2),
-                         "\t%s %s %s %s\n" % (self.startx, self.starty, self.endx, self.endy)]
+                         "\t%d %d %d %d\n" % (self.startx, self.starty, self.endx, self.endy)]
         return to_write
 
 class Entry(SchematicItem):
@@ -267,23 +408,23 @@ class Entry(SchematicItem):
         wire-bus entry
         bus-bus entry    
     """
-    def __init__(self, data):
-        self.raw_data = data
+    __slots__ = ('type1', 'type2', 'startx', 'starty', 'endx', 'endy')
 
+    def __init__(self, data):
         tokens = data[0].split()
-        self.type1 = tokens[1]
-        self.type2 = tokens[2]
+        _set(self, 'type1', tokens[1])
+        _set(self, 'type2', tokens[2])
 
-        tokens = data[1].split()
-        self.startx = tokens[0]
-        self.starty = tokens[1]
-        self.endx = tokens[2]
-        self.endy = tokens[3]
+        startx, starty, endx, endy = [int(v) for v in data[1].split()[:4]]
+        _set(self, 'startx', startx)
+        _set(self, 'starty', starty)
+        _set(self, 'endx', endx)
+        _set(self, 'endy', endy)
 
     def get_text (self):
         to_write = []
         to_write += ["Entry %s %s\n" % (self.type1, self.type2),
-                         "\t%s %s %s %s\n" % (self.startx, self.starty, self.endx, self.endy)]
+                         "\t%d %d %d %d\n" % (self.startx, self.starty, self.endx, self.endy)]
         return to_write
 
 class Text (SchematicItem):
@@ -294,40 +435,40 @@ class Text (SchematicItem):
         GLabel  global label
         HLabel  hierarchical label
     """
-    def __init__(self, data):
-        self.raw_data = data
+    __slots__ = ('type', 'posx', 'posy', 'orientation', 'textsize', 'shape', 'italic', 'bold', 'data')
 
+    def __init__(self, data):
         # type = Label Notes GLabel HLabel
 
         tokens = data[0].split()
-        self.type = tokens[1]
-        self.posx = tokens[2]
-        self.posy = tokens[3]
-        self.orientation = tokens[4]
-        self.textsize = tokens[5]
+        _set(self, 'type', tokens[1])
+        _set(self, 'posx', int(tokens[2]))
+        _set(self, 'posy', int(tokens[3]))
+        _set(self, 'orientation', tokens[4])
+        _set(self, 'textsize', tokens[5])
 
         if self.type in ["GLabel", "HLabel"]:
-            self.shape = tokens[6]
-            self.italic = True if tokens[7] == "Italic" else False
-            self.bold = True if len(tokens)>8 and tokens[8] != "0" else False
+            _set(self, 'shape', tokens[6])
+            _set(self, 'italic', True if tokens[7] == "Italic" else False)
+            _set(self, 'bold', True if len(tokens)>8 and tokens[8] != "0" else False)
         else:
-            self.shape = ""
-            self.italic = True if tokens[6] == "Italic" else False
-            self.bold = True if len(tokens)>7 and tokens[7] != "0" else False
+            _set(self, 'shape', "")
+            _set(self, 'italic', True if tokens[6] == "Italic" else False)
+            _set(self, 'bold', True if len(tokens)>7 and tokens[7] != "0" else False)
 
         line = data[1].rstrip()
-        self.data = line
+        _set(self, 'data', line)
 
     def get_text (self):
         to_write = []
         if self.type in ["GLabel", "HLabel"]:
-            to_write += ["Text %s %s %s %s %s %s %s %s\n" % (
+            to_write += ["Text %s %d %d %s %s %s %s %s\n" % (
                             self.type, self.posx, self.posy, self.orientation, self.textsize, self.shape,
                             "Italic" if self.italic else "~",
                             10 if self.bold else 0),
                             self.data+'\n']
         else:
-            to_write += ["Text %s %s %s %s %s %s %s\n" % (
+            to_write += ["Text %s %d %d %s %s %s %s\n" % (
                             self.type, self.posx, self.posy, self.orientation, self.textsize,
                             "Italic" if self.italic else "~",
                             10 if self.bold else 0),
@@ -338,46 +479,132 @@ class Connection(SchematicItem):
     """
     A connection dot aka junction
     """
-    def __init__(self, data):
-        self.raw_data = data
+    __slots__ = ('posx', 'posy')
 
+    def __init__(self, data):
         tokens = data.split()
-        self.posx = tokens[2]
-        self.posy = tokens[3]
+        _set(self, 'posx', int(tokens[2]))
+        _set(self, 'posy', int(tokens[3]))
 
     def get_text (self):
         to_write = []
-        to_write += ["Connection ~ %s %s\n" % (self.posx, self.posy)]
+        to_write += ["Connection ~ %d %d\n" % (self.posx, self.posy)]
         return to_write
 
 class NoConnect(SchematicItem):
     """
     A No Connect symbol (cross)
     """
-    def __init__(self, data):
-        self.raw_data = data
+    __slots__ = ('posx', 'posy')
 
+    def __init__(self, data):
         tokens = data.split()
-        self.posx = tokens[2]
-        self.posy = tokens[3]
+        _set(self, 'posx', int(tokens[2]))
+        _set(self, 'posy', int(tokens[3]))
 
     def get_text (self):
         to_write = []
-        to_write += ["NoConn ~ %s %s\n" % (self.posx, self.posy)]
+        to_write += ["NoConn ~ %d %d\n" % (self.posx, self.posy)]
         return to_write
 
+# first token of the line starting an item -> (class, number of lines),
+# None for blocks ending with a $End line
+_ITEM_STARTS = {
+    'Text':         (Text, 2),
+    'Wire':         (Wire, 2),
+    'Entry':        (Entry, 2),
+    'Connection':   (Connection, 1),
+    'NoConn':       (NoConnect, 1),
+    '$Comp':        (Component, None),
+    '$Sheet':       (Sheet, None),
+    '$Bitmap':      (Bitmap, None),
+    }
+
+def iter_items(filename, kinds=None):
+    """
+    Yield the items of a sheet file one at a time, without building a
+    Schematic. Only one item is held in memory, whatever the file size.
+
+    kinds is a collection of item classes to yield, e.g. (Wire, Text),
+    default all. Items of other kinds are skipped without being parsed.
+    """
+    with open(filename) as f:
+        if not 'EESchema Schematic File' in f.readline():
+            sys.stderr.write('The file is not a KiCad Schematic File\n')
+            return
+
+        for line in f:
+            tokens = line.split(None, 1)
+            if not tokens:
+                continue
+
+            start = _ITEM_STARTS.get(tokens[0])
+            if start is None:
+                if line.startswith('$'):
+                    # $Descr or unknown block
+                    for line in f:
+                        if line.startswith('$End'):
+                            break
+                continue
+
+            cls, n_lines = start
+            wanted = kinds is None or cls in kinds
+            if n_lines is None:
+                data = [line]
+                for line in f:
+                    if wanted:
+                        data.append(line)
+                    if line.startswith('$End'):
+                        if wanted:
+                            yield cls(data)
+                        break
+            elif n_lines == 1:
+                if wanted:
+                    yield cls(line)
+            else:
+                data = next(f, '')
+                if wanted:
+                    yield cls([line.rstrip(), data.strip()])
+
+def load(filename, lazy=False):
+    """Load a legacy .sch or a KiCad 6 .kicad_sch sheet, by file extension"""
+    if filename.lower().endswith('.kicad_sch'):
+        import kicad_sch
+        return kicad_sch.KicadSchematic(filename, lazy)
+    return Schematic(filename, lazy)
+
 class Schematic(object):
     """
     Container for Schematic sheet
+
+    With lazy=True, $Comp and $Sheet blocks are only parsed when one of
+    their attributes is first used, blocks never used are saved verbatim.
+
+    The lines read are kept, save() writes unmodified items from them.
+    Items changed in place, e.g. a field of a component, must be marked
+    with set_modified() first, see SchematicItem.
     """
-    def __init__(self, filename):
-        f = open(filename)
+    def __init__(self, filename, lazy=False):
+        with open(filename) as f:
+            lines = f.readlines()
+
         self.filename = filename
-        self.header = f.readline()
+        self.lazy = lazy
+        self.header = lines[0] if lines else ''
         self.libs = []
         self.eelayer = None
         self.description = None
+        self._init_items()
+
+        if not 'EESchema Schematic File' in self.header:
+            self.header = None
+            sys.stderr.write('The file is not a KiCad Schematic File\n')
+            return
 
+        self._lines = lines
+        self._load(lines)
+
+    def _init_items(self):
         self.components = []
         self.sheets = []
         self.bitmaps = []
@@ -389,99 +616,276 @@ class Schematic(object):
 
         self.objects = []
 
-        if not 'EESchema Schematic File' in self.header:
-            self.header = None
-            sys.stderr.write('The file is not a KiCad Schematic File\n')
-            return
-
-        building_block = False
-
-        while True:
-            line = f.readline()
-            if not line: break
+        # spatial index, built on first use
+        self.spatial = None
+
+        # number of items formatted again by the last save
+        self.rewritten = 0
+
+        # component indexes, key -> list of components
+        self._by_ref = {}
+        self._by_name = {}
+        self._by_time_stamp = {}
+        self._index_keys = {}
+
+        # the lines read, one list shared by the items loaded from it
+        self._lines = []
+
+    def take_lines(self):
+        """Empty the list of lines read and return its content, e.g. to
+        pickle the items without them. The items keep referring to the
+        list, which put_lines() fills again."""
+        lines = self._lines[:]
+        del self._lines[:]
+        return lines
+
+    def put_lines(self, lines):
+        """Fill the list of lines read, emptied by take_lines()"""
+        self._lines[:] = lines
+
+    def _load(self, lines):
+        """Build the object lists, dispatching on the first token of each line"""
+        handlers = self._HANDLERS
+        n = len(lines)
+        i = 1
+        while i < n:
+            line = lines[i]
+            tokens = line.split(None, 1)
+            if not tokens:
+                i += 1
+                continue
 
-            if line.startswith('LIBS:'):
+            handler = handlers.get(tokens[0])
+            if handler is not None:
+                i = handler(self, lines, i)
+            elif line.startswith('LIBS:'):
                 self.libs.append(line)
-
-            elif line.startswith('EELAYER END'):
-                pass
-            elif line.startswith('EELAYER'):
-                self.eelayer = line
-
-            elif not building_block:
-                if line.startswith('$'):
-                    building_block = True
-                    block_data = []
-                    block_data.append(line)
-                elif line.startswith('Text'):
-                    data = Text ([line.rstrip(), f.readline().strip()])
-                    self.texts.append(data)
-                    self.objects.append(data)
-
-                elif line.startswith('Wire'):
-                    data = Wire ([line.rstrip(), f.readline().strip()])
-                    self.wires.append(data)
-                    self.objects.append(data)
-
-                elif line.startswith('Entry'):
-                    data = Entry ([line.rstrip(), f.readline().strip()])
-                    self.entries.append(data)
-                    self.objects.append(data)
-
-                elif line.startswith('Connection'):
-                    data = Connection(line)
-                    self.conns.append(data)
-                    self.objects.append(data)
-
-                elif line.startswith('NoConn'):
-                    data = NoConnect(line)
-                    self.noconns.append(data)
-                    self.objects.append(data)
-
-            elif building_block:
-                block_data.append(line)
-                if line.startswith('$End'):
-                    building_block = False
-
-                    if line.startswith('$EndDescr'):
-                        self.description = Description(block_data)
-                    if line.startswith('$EndComp'):
-                        data=Component(block_data)
-                        self.components.append(data)
-                        self.objects.append(data)
-                    if line.startswith('$EndSheet'):
-                        data=Sheet(block_data)
-                        self.sheets.append(data)
-                        self.objects.append(data)
-                    if line.startswith('$EndBitmap'):
-                        data=Bitmap(block_data)
-                        self.bitmaps.append(data)
-                        self.objects.append(data)
+                i += 1
+            elif line.startswith('$'):
+                # unknown block, skip it
+                i = self._find_end(lines, i) + 1
+            else:
+                i += 1
+
+    @staticmethod
+    def _find_end(lines, i):
+        """Return the index of the $End line closing the block started at lines[i]"""
+        n = len(lines)
+        i += 1
+        while i < n and not lines[i].startswith('$End'):
+            i += 1
+        return i
+
+    @staticmethod
+    def _two_lines(lines, i):
+        return [lines[i].rstrip(), lines[i+1].strip() if i + 1 < len(lines) else '']
+
+    def _add(self, item, item_list, lines=None, start=0, end=0):
+        if lines is not None and end <= len(lines):
+            _set(item, '_span', (lines, start, end))
+        item_list.append(item)
+        self.objects.append(item)
+
+    def _load_eelayer(self, lines, i):
+        if not lines[i].startswith('EELAYER END'):
+            self.eelayer = lines[i]
+        return i + 1
+
+    def _load_text(self, lines, i):
+        self._add(Text(self._two_lines(lines, i)), self.texts, lines, i, i + 2)
+        return i + 2
+
+    def _load_wire(self, lines, i):
+        self._add(Wire(self._two_lines(lines, i)), self.wires, lines, i, i + 2)
+        return i + 2
+
+    def _load_entry(self, lines, i):
+        self._add(Entry(self._two_lines(lines, i)), self.entries, lines, i, i + 2)
+        return i + 2
+
+    def _load_connection(self, lines, i):
+        self._add(Connection(lines[i]), self.conns, lines, i, i + 1)
+        return i + 1
+
+    def _load_noconn(self, lines, i):
+        self._add(NoConnect(lines[i]), self.noconns, lines, i, i + 1)
+        return i + 1
+
+    def _load_descr(self, lines, i):
+        end = self._find_end(lines, i)
+        if end < len(lines):
+            self.description = Description(lines[i:end+1])
+        return end + 1
+
+    def _load_lazy_block(self, cls, item_list, lines, i):
+        end = self._find_end(lines, i)
+        if end < len(lines):
+            if self.lazy:
+                item = cls.lazy(lines, i, end+1)
+            else:
+                item = cls(lines[i:end+1])
+            self._add(item, item_list, lines, i, end+1)
+        return end + 1
+
+    def _load_comp(self, lines, i):
+        n = len(self.components)
+        i = self._load_lazy_block(Component, self.components, lines, i)
+        if len(self.components) > n:
+            self._index(self.components[-1])
+        return i
+
+    def _load_sheet(self, lines, i):
+        return self._load_lazy_block(Sheet, self.sheets, lines, i)
+
+    def _load_bitmap(self, lines, i):
+        end = self._find_end(lines, i)
+        if end < len(lines):
+            self._add(Bitmap(lines[i:end+1]), self.bitmaps, lines, i, end+1)
+        return end + 1
+
+    # first token of a line -> loader, each returns the index of the next line to read
+    _HANDLERS = {
+        'EELAYER':      _load_eelayer,
+        'Text':         _load_text,
+        'Wire':         _load_wire,
+        'Entry':        _load_entry,
+        'Connection':   _load_connection,
+        'NoConn':       _load_noconn,
+        '$Descr':       _load_descr,
+        '$Comp':        _load_comp,
+        '$Sheet':       _load_sheet,
+        '$Bitmap':      _load_bitmap,
+        }
+
+    def _index(self, comp):
+        keys = comp.index_keys()
+        self._index_keys[comp] = keys
+        for index, key in zip((self._by_ref, self._by_name, self._by_time_stamp), keys):
+            found = index.get(key)
+            if found is None:
+                index[key] = [comp]
+            else:
+                found.append(comp)
+
+    def _unindex(self, comp):
+        keys = self._index_keys.pop(comp)
+        for index, key in zip((self._by_ref, self._by_name, self._by_time_stamp), keys):
+            found = index[key]
+            found.remove(comp)
+            if not found:
+                del index[key]
+
+    def reindex(self, comp):
+        """Update the indexes after the labels or unit of comp were changed in place"""
+        self._unindex(comp)
+        self._index(comp)
+
+    def components_by_ref(self, ref):
+        """Components with reference ref, one per unit of a multi-unit part"""
+        return list(self._by_ref.get(ref, ()))
+
+    def components_by_name(self, name):
+        """Components of library symbol name"""
+        return list(self._by_name.get(name, ()))
+
+    def component_by_time_stamp(self, time_stamp):
+        found = self._by_time_stamp.get(time_stamp)
+        return found[0] if found else None
+
+    def component_names(self):
+        """Library symbol names used, sorted"""
+        return sorted(self._by_name)
+
+    def add_component(self, comp):
+        self.components.append(comp)
+        self.objects.append(comp)
+        self._index(comp)
+        if self.spatial is not None:
+            self.spatial.add(comp)
+
+    def remove_component(self, comp):
+        self.components.remove(comp)
+        self.objects.remove(comp)
+        self._unindex(comp)
+        if self.spatial is not None:
+            self.spatial.remove(comp)
+
+    def set_reference(self, comp, ref):
+        """Change the reference of comp, in its L line and F0 field"""
+        comp.labels['ref'] = ref
+        if comp.fields:
+            comp.fields[0]['ref'] = '"%s"' % ref
+        comp.set_modified()
+        self.reindex(comp)
+
+    def spatial_index(self, cell_size=500):
+        """Return the spatial index of all objects, building it on first use"""
+        if self.spatial is None:
+            import spatial
+            self.spatial = spatial.SpatialIndex(self.objects, cell_size)
+        return self.spatial
+
+    def items_moved(self, items=None):
+        """Update the spatial index, if built, after items (default all) have moved"""
+        if self.spatial is not None:
+            self.spatial.update_all(self.objects if items is None else items)
+
+    def iter_lines(self):
+        """Yield the lines of the sheet file, one item at a time.
+        Only modified items are formatted again, their number is left in
+        self.rewritten.
+        """
+        yield self.header
+        for line in self.libs:
+            yield line
+        if self.eelayer:
+            yield self.eelayer
+        yield 'EELAYER END\n'
+        if self.description:
+            for line in self.description.raw_data:
+                yield line
+        self.rewritten = 0
+        for item in self.objects:
+            text = item.source_lines()
+            if text is None:
+                text = item.get_text()
+                self.rewritten += 1
+            for line in text:
+                yield line
+        yield '$EndSCHEMATC\n'
 
     def save(self, filename=None):
+        """Write the sheet to filename, default the file it was loaded from.
+
+        The lines are streamed to a temporary file in the same directory
+        which then replaces the target in one rename, so the target is
+        never left half written. If the new content is identical to the
+        target, the target is left untouched. Returns True if written.
+        """
         # check whether it has header, what means that sch file was loaded fine
-        if not self.header: return
+        if not self.header: return False
 
         if not filename: filename = self.filename
 
-        # insert the header
-        to_write = []
-        to_write += [self.header]
-
-        # LIBS
-        to_write += self.libs
-
-        # EELAYER
-        to_write += [self.eelayer, 'EELAYER END\n']
-
-        # Description
-        to_write += self.description.raw_data
-
-        # 
-        for item in self.objects:
-            to_write.extend (item.get_text())
-
-        to_write += ['$EndSCHEMATC\n']
-
-        f = open(filename, 'w')
-        f.writelines(to_write)
+        path = os.path.dirname(os.path.abspath(filename))
+        fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(filename), suffix='.tmp', dir=path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(self.iter_lines())
+                f.flush()
+                os.fsync(f.fileno())
+
+            if os.path.exists(filename):
+                if filecmp.cmp(temp, filename, shallow=False):
+                    os.remove(temp)
+                    return False
+                shutil.copymode(filename, temp)
+            else:
+                # mkstemp creates it readable by the owner only
+                os.chmod(temp, new_file_mode())
+            replace_file(temp, filename)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return True
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tokenizer and tree builder for KiCad S-expression files
+
+See syntax/kicad_schema_v6.txt. Each expression becomes a list,
+[keyword, parameter, ...], where parameters are nested lists or str:
+quoted strings are unquoted and unescaped, keywords and numbers are kept
+as written.
+
+Neither the tokenizer nor the builder recurse, so nesting depth is not
+limited by the Python stack. The input is tokenized a block of lines at
+a time, which relies on strings not holding a literal newline; KiCad
+writes newlines in strings as \\n.
+"""
+
+import re
+
+_TOKEN_RE = re.compile(r'[()]|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+_ESCAPE_RE = re.compile(r'\\(.)')
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r'}
+
+# lines tokenized at once
+BLOCK_LINES = 4096
+
+
+def unescape(s):
+    """Undo the backslash escapes of a quoted string"""
+    return _ESCAPE_RE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), s)
+
+
+def quote(s):
+    """Quote a string as KiCad writes it"""
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _token_blocks(lines):
+    findall = _TOKEN_RE.findall
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) == BLOCK_LINES:
+            yield findall(''.join(block))
+            block = []
+    if block:
+        yield findall(''.join(block))
+
+
+def tokens(lines):
+    """Yield the tokens of an iterable of lines, e.g. a file: '(', ')',
+    quoted strings as written, and atoms
+    """
+    for block in _token_blocks(lines):
+        for token in block:
+            yield token
+
+
+def _build(lines, stream):
+    stack = []
+    current = None
+    for block in _token_blocks(lines):
+        for token in block:
+            if token == '(':
+                if current is not None:
+                    stack.append(current)
+                current = []
+            elif token == ')':
+                if current is None:
+                    raise ValueError("unexpected ')'")
+                if not stack:
+                    if not stream:
+                        yield current
+                    return
+                parent = stack.pop()
+                if stream and not stack:
+                    yield current
+                else:
+                    parent.append(current)
+                current = parent
+            else:
+                if current is None:
+                    raise ValueError("%s outside of an expression" % token)
+                if token[0] == '"':
+                    token = token[1:-1]
+                    if '\\' in token:
+                        token = unescape(token)
+                current.append(token)
+    if current is not None:
+        raise ValueError("missing ')'")
+
+
+def parse(lines):
+    """Return the first top level expression of an iterable of lines"""
+    for expr in _build(lines, False):
+        return expr
+    raise ValueError("no expression found")
+
+
+def iter_children(lines):
+    """Yield the expressions inside the top level one, each as soon as it
+    is complete, so only one of them is held in memory at a time. The
+    atoms of the top level expression itself are skipped.
+    """
+    return _build(lines, True)
+
+
+def find(expr, keyword):
+    """First sub-expression of expr starting with keyword, None if none"""
+    for param in expr:
+        if type(param) is list and param and param[0] == keyword:
+            return param
+    return None
+
+
+def find_all(expr, keyword):
+    """All sub-expressions of expr starting with keyword"""
+    return [param for param in expr if type(param) is list and param and param[0] == keyword]
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+Spatial index over the items of a sch.Schematic
+
+Items are hashed into a uniform grid of square cells, an item is entered
+in every cell its bounding box overlaps. Wires and bus entries are
+treated as segments, sheets as rectangles and everything else as a
+point at (posx, posy).
+"""
+
+import sch
+
+
+_SEGMENTS = (sch.Wire, sch.Entry)
+
+
+def item_bounds(item):
+    """Bounding box (minx, miny, maxx, maxy) of a schematic item"""
+    if isinstance(item, _SEGMENTS):
+        return (min(item.startx, item.endx), min(item.starty, item.endy),
+                max(item.startx, item.endx), max(item.starty, item.endy))
+    elif isinstance(item, sch.Sheet):
+        return (item.posx, item.posy, item.posx + item.width, item.posy + item.height)
+    else:
+        return (item.posx, item.posy, item.posx, item.posy)
+
+
+def _orientation(ax, ay, bx, by, cx, cy):
+    d = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    return (d > 0) - (d < 0)
+
+
+def _on_segment(ax, ay, bx, by, px, py):
+    """p is collinear with a-b, is it within its extent?"""
+    return min(ax, bx) <= px <= max(ax, bx) and min(ay, by) <= py <= max(ay, by)
+
+
+def segments_touch(ax, ay, bx, by, cx, cy, dx, dy):
+    """True if segment a-b and segment c-d share at least one point.
+    Either segment may be a single point.
+    """
+    o1 = _orientation(ax, ay, bx, by, cx, cy)
+    o2 = _orientation(ax, ay, bx, by, dx, dy)
+    o3 = _orientation(cx, cy, dx, dy, ax, ay)
+    o4 = _orientation(cx, cy, dx, dy, bx, by)
+
+    if o1 != o2 and o3 != o4:
+        return True
+
+    return ((o1 == 0 and _on_segment(ax, ay, bx, by, cx, cy)) or
+            (o2 == 0 and _on_segment(ax, ay, bx, by, dx, dy)) or
+            (o3 == 0 and _on_segment(cx, cy, dx, dy, ax, ay)) or
+            (o4 == 0 and _on_segment(cx, cy, dx, dy, bx, by)))
+
+
+def segment_touches_box(ax, ay, bx, by, minx, miny, maxx, maxy):
+    """True if segment a-b touches the rectangle, edges included"""
+    if minx <= ax <= maxx and miny <= ay <= maxy:
+        return True
+    if minx <= bx <= maxx and miny <= by <= maxy:
+        return True
+    return (segments_touch(ax, ay, bx, by, minx, miny, maxx, miny) or
+            segments_touch(ax, ay, bx, by, maxx, miny, maxx, maxy) or
+            segments_touch(ax, ay, bx, by, maxx, maxy, minx, maxy) or
+            segments_touch(ax, ay, bx, by, minx, maxy, minx, miny))
+
+
+def item_touches_segment(item, ax, ay, bx, by):
+    """True if the geometry of item touches segment a-b"""
+    if isinstance(item, _SEGMENTS):
+        return segments_touch(item.startx, item.starty, item.endx, item.endy, ax, ay, bx, by)
+    elif isinstance(item, sch.Sheet):
+        return segment_touches_box(ax, ay, bx, by, *item_bounds(item))
+    else:
+        return segments_touch(ax, ay, bx, by, item.posx, item.posy, item.posx, item.posy)
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid hash of schematic items
+
+    cell_size is in schematic units (mils), it should be a few times the
+    length of a typical wire.
+    """
+
+    def __init__(self, items=None, cell_size=500):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+        if items:
+            for item in items:
+                self.add(item)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cells(self, minx, miny, maxx, maxy):
+        size = self.cell_size
+        x0 = minx // size
+        x1 = maxx // size
+        y0 = miny // size
+        y1 = maxy // size
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+    def add(self, item):
+        bounds = item_bounds(item)
+        self.bounds[item] = bounds
+        for key in self._cells(*bounds):
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = [item]
+            else:
+                cell.append(item)
+
+    def remove(self, item):
+        bounds = self.bounds.pop(item)
+        for key in self._cells(*bounds):
+            cell = self.cells[key]
+            cell.remove(item)
+            if not cell:
+                del self.cells[key]
+
+    def update(self, item):
+        """Re-index an item after it has moved, returns True if it had"""
+        if item_bounds(item) == self.bounds.get(item):
+            return False
+        if item in self.bounds:
+            self.remove(item)
+        self.add(item)
+        return True
+
+    def update_all(self, items):
+        """Re-index any of items that have moved, returns the number moved"""
+        moved = 0
+        for item in items:
+            if self.update(item):
+                moved += 1
+        return moved
+
+    def _candidates(self, minx, miny, maxx, maxy):
+        """Items in the cells overlapping the box, each once"""
+        found = []
+        seen = set()
+        cells = self.cells
+        for key in self._cells(minx, miny, maxx, maxy):
+            for item in cells.get(key, ()):
+                if id(item) not in seen:
+                    seen.add(id(item))
+                    found.append(item)
+        return found
+
+    def at(self, x, y):
+        """Items at the point (x, y): points equal to it, segments passing
+        through it and sheets containing it
+        """
+        size = self.cell_size
+        bounds = self.bounds
+        found = []
+        for item in self.cells.get((x // size, y // size), ()):
+            bx0, by0, bx1, by1 = bounds[item]
+            if bx0 <= x <= bx1 and by0 <= y <= by1:
+                # the bounds are exact for all but diagonal segments
+                if bx0 == bx1 or by0 == by1 or not isinstance(item, _SEGMENTS) or \
+                        item_touches_segment(item, x, y, x, y):
+                    found.append(item)
+        return found
+
+    def in_box(self, minx, miny, maxx, maxy):
+        """Items touching the rectangle, edges included"""
+        found = []
+        for item in self._candidates(minx, miny, maxx, maxy):
+            bx0, by0, bx1, by1 = self.bounds[item]
+            if bx1 < minx or bx0 > maxx or by1 < miny or by0 > maxy:
+                continue
+            if isinstance(item, _SEGMENTS):
+                if not segment_touches_box(item.startx, item.starty, item.endx, item.endy,
+                                           minx, miny, maxx, maxy):
+                    continue
+            found.append(item)
+        return found
+
+    def touching_segment(self, ax, ay, bx, by):
+        """Items touching the segment a-b"""
+        minx, maxx = min(ax, bx), max(ax, bx)
+        miny, maxy = min(ay, by), max(ay, by)
+        found = []
+        for item in self._candidates(minx, miny, maxx, maxy):
+            bx0, by0, bx1, by1 = self.bounds[item]
+            if bx1 < minx or bx0 > maxx or by1 < miny or by0 > maxy:
+                continue
+            if item_touches_segment(item, ax, ay, bx, by):
+                found.append(item)
+        return found
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Line tokenizers for KiCad legacy file formats
+"""
+
+import re
+
+# a double quoted string, quotes escaped with a backslash do not delimit it
+_QUOTED = r'(?<!\\)".*?(?<!\\)"'
+
+# bare words and quoted strings, as separate pieces
+_PIECE_RE = re.compile(r'[^\s"]+|' + _QUOTED)
+
+# as above, but a word ending in '=' takes a directly following quoted string
+# with it, e.g. Path="/5A1B2C3D"
+_TOKEN_RE = re.compile(r'[^\s"]+=' + _QUOTED + r'|[^\s"]+|' + _QUOTED)
+
+
+def _merge_pieces(pieces):
+    """Merge any piece ending with an equals sign with the next piece"""
+    tokens = []
+    i = 0
+    n = len(pieces)
+    while i < n:
+        piece = pieces[i]
+        if piece[-1] == '=' and i + 1 < n:
+            piece += pieces[i+1]
+            i += 1
+        tokens.append(piece)
+        i += 1
+    return tokens
+
+
+def _split_quoted(parts):
+    """Tokens of a line split at its quotes, None if a quoted string
+    spans a line break, which the regular expressions do not match"""
+    tokens = parts[0].split()
+    for i in range(1, len(parts), 2):
+        if '\n' in parts[i]:
+            return None
+        tokens.append('"' + parts[i] + '"')
+        tokens += parts[i+1].split()
+    return tokens
+
+
+def split_line(line):
+    """Split a schematic line into tokens
+
+    Quoted strings are kept as one token including the quotes, and a
+    key= piece is merged with its value, so that
+        AR Path="/5A1B2C3D" Ref="R1"  Part="1"
+    gives ['AR', 'Path="/5A1B2C3D"', 'Ref="R1"', 'Part="1"']
+    """
+    if '"' not in line and '=' not in line:
+        return line.split()
+
+    if '=' not in line and '\\' not in line:
+        # e.g. F lines, split with str.split rather than the regular expressions
+        parts = line.split('"')
+        if len(parts) % 2:
+            tokens = _split_quoted(parts)
+            if tokens is not None:
+                return tokens
+
+    tokens = _TOKEN_RE.findall(line)
+
+    if '=' in line:
+        # key= not directly followed by a quoted value, e.g. "key= value"
+        for token in tokens:
+            if token[-1] == '=':
+                return _merge_pieces(_PIECE_RE.findall(line))
+
+    return tokens
+
+
+# library lines, split as by a non-posix shlex with whitespace_split and
+# only '"' as quote: a quote opens a string only at the start of a token,
+# the string ends at the next quote and is a token of its own. An opening
+# quote without a closing one takes the rest of the line, see below.
+_LIB_TOKEN_RE = re.compile(r'"[^"]*"?|[^ \t\r\n"][^ \t\r\n]*')
+
+# whitespace as shlex sees it, str.split() also splits on others
+_OTHER_SPACE_RE = re.compile(r'[^\S \t\r\n]')
+
+
+def split_lib_line(line):
+    """Split a symbol library line into tokens, exactly as
+        s = shlex.shlex(line)
+        s.whitespace_split = True
+        s.commenters = ''
+        s.quotes = '"'
+        list(s)
+    does, including ValueError for an unclosed quote
+    """
+    if '"' not in line:
+        if _OTHER_SPACE_RE.search(line) is None:
+            return line.split()
+        return _LIB_TOKEN_RE.findall(line)
+
+    tokens = _LIB_TOKEN_RE.findall(line)
+    last = tokens[-1]
+    if last[0] == '"' and (len(last) == 1 or last[-1] != '"'):
+        raise ValueError("No closing quotation")
+    return tokens
+
+
+def make_dict(keys, values):
+    """Map keys onto values, keys without a value are set to ''"""
+    d = dict(zip(keys, values))
+    if len(values) < len(keys):
+        for key in keys[len(values):]:
+            d[key] = ''
+    return d
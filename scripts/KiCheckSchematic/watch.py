@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Polling of files for changes, for --watch
+
+FileWatcher keeps the size and mtime of a set of files and reports the
+files whose size or mtime differ from the last poll, including files
+which appeared or were removed. Polling needs no extra module and works
+the same on every platform; stating the few hundred files of a project
+takes a millisecond or so.
+"""
+
+import os
+import time
+
+# seconds between polls
+INTERVAL = 0.25
+
+# seconds without further changes before a change is reported, so that a
+# file is not read while an editor is still writing it
+SETTLE = 0.1
+
+
+def _state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class FileWatcher(object):
+    """
+    The files watched by absolute name, see watch(), changed() and wait()
+    """
+
+    def __init__(self, filenames=()):
+        self.states = {}
+        self.watch(filenames)
+
+    def watch(self, filenames):
+        """Watch filenames from now on, instead of the files watched before.
+        Files watched before keep their state, changes to them since the
+        last poll are still reported."""
+        states = {}
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            states[path] = self.states[path] if path in self.states else _state(path)
+        self.states = states
+
+    def changed(self):
+        """The files changed since the last poll, sorted"""
+        changed = []
+        for path, state in self.states.items():
+            now = _state(path)
+            if now != state:
+                self.states[path] = now
+                changed.append(path)
+        return sorted(changed)
+
+    def wait(self, interval=INTERVAL, settle=SETTLE):
+        """Poll every interval seconds until files change, and then until
+        they stop changing for settle seconds; return the files changed"""
+        changed = self.changed()
+        while not changed:
+            time.sleep(interval)
+            changed = self.changed()
+
+        while True:
+            time.sleep(settle)
+            more = self.changed()
+            if not more:
+                return changed
+            changed = sorted(set(changed) | set(more))